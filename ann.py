@@ -0,0 +1,181 @@
+"""
+Approximate Nearest Neighbours
+==============================
+
+An inverted file (IVF) index: unit vectors of all targets of a model
+are partitioned by (spherical) k-means, and a query visits only the
+`nprobe` partitions (lists) with the closest centroids.  Candidates
+found there are then re-ranked by the exact similarities of the model.
+
+    [NAME]-ivf-centroids.npy  # (nlist, dim) unit centroids
+    [NAME]-ivf-offsets.npy    # (nlist + 1, ) boundaries of the lists
+    [NAME]-ivf-ids.npy        # targets grouped by the lists
+    [NAME]-ivf-points.npy     # (vocab, dim) unit vectors of the targets
+
+For `Word2Vec` and `SkEThesSVD`, the vectors are their normalized
+embeddings.  Sparse rows
+of `SkEThes` matrices are hashed into `dim` dimensions first (each
+context is added with a random sign to a random dimension), which
+preserves their cosine similarities approximately (the more
+dimensions, the better).
+
+    from ann import build_ivf, IVFIndex
+
+    build_ivf(model, "bnc2-matrix")
+    model.use_ann(IVFIndex("bnc2-matrix", nprobe=8))
+    model.most_similar("house", approximate=True)
+
+More probed lists (`nprobe`) and more re-ranked candidates (`rerank`
+of `use_ann`) mean a higher recall and slower queries.
+"""
+
+import numpy as np
+
+from scipy.sparse import csr_matrix
+from sklearn.preprocessing import normalize
+
+# Local imports
+from deval import BLOCK_SIZE, top_indices
+
+
+ARRAYS = ("centroids", "offsets", "ids", "points")
+
+
+def model_points(model, dim=512, seed=0, block_size=16 * BLOCK_SIZE):
+    """
+    Returns (vocab, dim) float32 unit vectors of the targets of `model`
+    """
+
+    if hasattr(model, "M"):  # SkEThes
+        M = model.M
+        rs = np.random.RandomState(seed)
+
+        # Feature hashing: one signed cell per context
+        hashing = csr_matrix(
+            (rs.choice([-1.0, 1.0], M.shape[1]),
+             (np.arange(M.shape[1]), rs.randint(0, dim, M.shape[1]))),
+            shape=(M.shape[1], dim)
+        )
+
+        points = np.zeros((M.shape[0], dim), dtype=np.float32)
+        for beg in range(0, M.shape[0], block_size):
+            points[beg:beg + block_size] = M[beg:beg + block_size].dot(
+                hashing).toarray()
+    elif getattr(model, "vectors", None) is not None:  # SVD or quantized
+        points = np.array(model.vectors[:], dtype=np.float32)
+    else:  # Word2Vec
+        points = np.array(model.model.vectors, dtype=np.float32)
+
+    return normalize(points, copy=False)
+
+
+def build_ivf(model, name, nlist=None, dim=512, iterations=10,
+              sample_size=None, seed=0):
+    """
+    Builds and saves an IVF index of all the targets of `model`
+
+    `nlist` (the nb of lists) defaults to 4 * sqrt(vocab).  Centroids are
+    trained on a random sample of `sample_size` (64 * nlist) targets.
+    """
+
+    points = model_points(model, dim, seed)
+    rs = np.random.RandomState(seed)
+
+    if nlist is None:
+        nlist = int(4 * np.sqrt(len(points)))
+    nlist = max(1, min(nlist, len(points)))
+
+    if sample_size is None:
+        sample_size = 64 * nlist
+    sample = points[np.sort(rs.choice(
+        len(points), min(sample_size, len(points)), replace=False))]
+
+    centroids = _kmeans(sample, nlist, iterations, rs)
+
+    lists = _nearest(points, centroids)
+    ids = np.argsort(lists, kind="mergesort").astype(np.int32)
+    offsets = np.zeros((nlist + 1, ), dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(lists, minlength=nlist))
+
+    for array, values in zip(ARRAYS, (centroids, offsets, ids, points)):
+        np.save(name + "-ivf-" + array + ".npy", values)
+
+
+def _kmeans(sample, nlist, iterations, rs):
+    """
+    Spherical k-means: returns (nlist, dim) unit centroids
+    """
+
+    centroids = sample[rs.choice(len(sample), nlist, replace=False)]
+
+    for __ in range(iterations):
+        lists = _nearest(sample, centroids)
+
+        # Sums of the points of each list (by a sparse product)
+        membership = csr_matrix(
+            (np.ones(len(sample), dtype=np.float32),
+             (lists, np.arange(len(sample)))),
+            shape=(nlist, len(sample))
+        )
+        sums = np.asarray(membership.dot(sample), dtype=np.float32)
+
+        # Empty lists get random points
+        empty = np.flatnonzero(np.bincount(lists, minlength=nlist) == 0)
+        sums[empty] = sample[rs.choice(len(sample), len(empty))]
+
+        centroids = normalize(sums, copy=False)
+
+    return centroids
+
+
+def _nearest(points, centroids, block_size=16 * BLOCK_SIZE):
+    """
+    Returns index of the most similar centroid of each point
+    """
+
+    nearest = np.zeros((len(points), ), dtype=np.int64)
+    for beg in range(0, len(points), block_size):
+        nearest[beg:beg + block_size] = np.argmax(
+            points[beg:beg + block_size].dot(centroids.T), axis=1)
+
+    return nearest
+
+
+class IVFIndex(object):
+
+    def __init__(self, name, nprobe=8, mmap_mode="r"):
+        """
+        `nprobe` is the default nb of lists visited by a query
+        """
+
+        self.centroids, self.offsets, self.ids, self.points = (
+            np.load(name + "-ivf-" + array + ".npy", mmap_mode=mmap_mode)
+            for array in ARRAYS
+        )
+        self.nprobe = nprobe
+
+    def candidates(self, query, nprobe=None):
+        """
+        Returns ids of the targets in the `nprobe` lists closest
+        to the vector `query`
+        """
+
+        nprobe = self.nprobe if nprobe is None else nprobe
+
+        lists = top_indices(self.centroids.dot(query), nprobe)
+
+        return np.concatenate([
+            self.ids[self.offsets[k]:self.offsets[k + 1]] for k in lists
+        ])
+
+    def search(self, query, topn=10, nprobe=None):
+        """
+        Returns (ids, scores) of the `topn` targets whose vectors
+        are the most similar to the vector `query`
+        """
+
+        cands = self.candidates(query, nprobe)
+        scores = self.points[cands].dot(query)
+        top = top_indices(scores, topn)
+
+        return cands[top], scores[top]
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+"""
+Benchmark of Weightings
+=======================
+
+Compares the vectorized weightings with the original row-by-row
+implementations on a random matrix:
+
+    python bench_weightings.py [NB_ROWS] [NB_COLS] [DENSITY]
+"""
+
+import sys
+import time
+import numpy as np
+
+from scipy.sparse import csr_matrix
+
+# Local imports
+from weightings import ppmi, log_dice
+
+
+def ppmi_loop(m):
+
+    all_sum = m.sum()
+    row_sums = np.array(m.sum(axis=1))[:, 0]
+    col_sums = np.array(m.sum(axis=0))[0, :]
+
+    m.data *= all_sum
+
+    denom = col_sums[m.indices]
+    #
+    for i in range(m.shape[0]):
+        beg, end = m.indptr[i], m.indptr[i + 1]
+        denom[beg:end] *= row_sums[i]
+    #
+    m.data /= 0.00001 + denom
+
+    m.data = np.log(m.data).clip(min=0.0)
+
+
+def log_dice_loop(m):
+
+    row_sums = np.array(m.sum(axis=1))[:, 0]
+    col_sums = np.array(m.sum(axis=0))[0, :]
+
+    m.data *= 2
+
+    denom = col_sums[m.indices] + 0.00001
+    #
+    for i in range(m.shape[0]):
+        beg, end = m.indptr[i], m.indptr[i + 1]
+        denom[beg:end] += row_sums[i]
+    #
+    m.data /= denom
+
+    m.data = (14 + np.log2(m.data)).clip(min=0.0)
+
+
+def timed(weighting, m):
+    m = m.copy()
+    start = time.time()
+    weighting(m)
+    return time.time() - start, m
+
+
+def main():
+
+    nb_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10**5
+    nb_cols = int(sys.argv[2]) if len(sys.argv) > 2 else 10**5
+    density = float(sys.argv[3]) if len(sys.argv) > 3 else 10**-3
+
+    random = np.random.RandomState(0)
+    nb_values = int(nb_rows * nb_cols * density)
+    m = csr_matrix(
+        (np.floor(random.rand(nb_values) * 100),  # zeros as well
+         (random.randint(0, nb_rows, nb_values),
+          random.randint(0, nb_cols, nb_values))),
+        shape=(nb_rows, nb_cols)
+    )
+
+    print("Matrix %i x %i, %i values" % (nb_rows, nb_cols, m.nnz))
+
+    for name, loop, vectorized in [("ppmi", ppmi_loop, ppmi),
+                                   ("log_dice", log_dice_loop, log_dice)]:
+
+        chunked = lambda x: vectorized(x, chunk_size=max(1, m.nnz // 10))
+
+        t_loop, m_loop = timed(loop, m)
+        t_vect, m_vect = timed(vectorized, m)
+        t_chunk, m_chunk = timed(chunked, m)
+
+        print("%-9s loop: %.3fs  vectorized: %.3fs  chunked: %.3fs  "
+              "equal: %s" % (name, t_loop, t_vect, t_chunk,
+                             np.array_equal(m_loop.data, m_vect.data)
+                             and np.array_equal(m_loop.data, m_chunk.data)))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,123 +9,374 @@ run this from terminal (see `main` function)
 ... or for corpora in arbitrary format, use `count_coocs` function.
 """
 
+import argparse
+import os
 import pickle
+import shutil
 import sys
+import tempfile
 import numpy as np
 
 from collections import defaultdict
-from scipy.sparse import coo_matrix, csr_matrix
 
 # Local imports
-from misc import LineCorpus
+import csrformat
+from misc import LineCorpus, corpus2vocab, imap_forked, split_lines
+from runs import SortedRuns, ArrayWriter, MEMORY, encode, decode
+from vocab import Vocabulary
 
 
 REPORT_DELAY = 10**5  # in struct. items (e.g. sentences)
-ARR_SIZE = 10 ** 8
+BATCH_SIZE = 10**4  # nb of sentences counted at once
+VOCAB_SUFFIX = ".vocab.pickle"  # for cached vocabularies
 
 
-def count_coocs(corpus, output_name, min_count=1, window=4):
+def count_coocs(corpus, output_name, min_count=1, window=4,
+                memory=MEMORY, tmp_dir=None, workers=1,
+                vocab=None, cache_vocab=False, dtype=np.float64,
+                upper=False, linear=False):
     """
     `corpus` should be a stream of sentences,
     where sentence is a non-empty list of words
+
+    Co-occurrences are counted in batches of sentences and spilled
+    to `tmp_dir` as sorted runs whenever they exceed `memory` bytes.
+
+    With `workers` > 1, `corpus` must be a `LineCorpus` over a plain
+    text file.  The file is split into byte ranges which are counted
+    (both passes) by a pool of processes, each with its share of
+    `memory`.  The output is identical to the one of a single process.
+
+    The vocabulary pass is skipped if `vocab` is given -- either
+    a dictionary {word: count} or a file saved by `save_vocab`.
+    With `cache_vocab`, the vocabulary of a whole `LineCorpus` (other
+    corpora raise ValueError) is kept in [CORPUS_FILE].vocab.pickle
+    and reused as long as the corpus file does not change.  In both
+    cases, words are pruned by `min_count` when loaded, so the same
+    file serves any `min_count`.
+
+    Values are written as `dtype` (np.float32 halves the matrix,
+    like the one of `wm2thes.py`).
+
+    The matrix is symmetric.  With `upper`, only its upper triangle
+    (target <= context) is stored, which halves the files, and the
+    output is marked as such (see `csrformat.py`).  Models expand it
+    when loaded.
+
+    Within the `window`, just the adjacent words are counted (weight 1),
+    as the original script did (its weights `(window - k) / window`
+    were integer divisions).  With `linear`, a context at distance `d`
+    gets weight `(window - d + 1) / window` instead.
     """
 
     assert min_count >= 1
     assert window >= 1
+    assert workers >= 1
 
-    print("Building vocab...")
-
-    vocab = defaultdict(lambda: 0)
+    shards = (
+        split_lines(corpus.file_name, workers) if workers > 1 else None
+    )
 
-    for sentence in corpus:
-        for word in sentence:
-            vocab[word] += 1
+    cache_file = None
+    if cache_vocab:
+        if corpus_key(corpus) is None:
+            raise ValueError("Only the vocabulary of a whole LineCorpus "
+                             "can be cached.")
+        cache_file = corpus.file_name + VOCAB_SUFFIX
+
+    if vocab is None and cache_file is not None:
+        vocab = load_vocab(cache_file, corpus)
+
+    if type(vocab) in (str, unicode):
+        vocab = load_vocab(vocab)
+
+    if vocab is not None:
+        print("Using precomputed vocab.")
+    elif shards is None:
+        print("Building vocab...")
+        vocab = corpus2vocab(corpus)
+        if cache_file is not None:
+            save_vocab(cache_file, vocab, corpus)
+    else:
+        print("Building vocab...")
+        vocab = defaultdict(lambda: 0)
+        for shard_vocab in imap_forked(
+                _vocab_worker,
+                [(corpus.file_name, beg, end) for beg, end in shards],
+                workers):
+            for word, count in shard_vocab.items():
+                vocab[word] += count
+        if cache_file is not None:
+            save_vocab(cache_file, vocab, corpus)
 
     vocab = {w: c for w, c in vocab.items() if c >= min_count}
 
     print("Vocabulary built.")
 
-    sorted_vocab = sorted(vocab.items(), key=lambda (w, c): c, reverse=True)
+    # Ties are broken by words, so that indices are deterministic
+    sorted_vocab = sorted(vocab.items(), key=lambda (w, c): (-c, w))
     word2i = {word: i for i, (word, _) in enumerate(sorted_vocab)}
 
-    rows = np.zeros((ARR_SIZE, ), dtype=np.int32)
-    cols = np.zeros((ARR_SIZE, ), dtype=np.int32)
-    vals = np.zeros((ARR_SIZE, ), dtype=np.int32)
-    ind = 0
-    max_ind = ARR_SIZE
-    shape = (len(vocab), len(vocab))
+    runs = SortedRuns(memory, tmp_dir)
 
-    m = coo_matrix(shape, dtype=np.float64)
-    weights = np.array([(window - k) / window for k in range(window)])
+    if shards is None:
+        count_corpus(corpus, word2i, runs, window, upper, linear)
+    else:
+        # Workers are forked, so they share `word2i`
+        for run_paths in imap_forked(
+                _count_worker,
+                [(corpus.file_name, beg, end) for beg, end in shards],
+                workers, word2i=word2i, window=window, upper=upper,
+                linear=linear, memory=memory // workers,
+                directory=runs.directory):
+            runs.extend(run_paths)
 
-    for i, sentence in enumerate(corpus):
-        sentence = np.array([word2i[w] for w in sentence if w in word2i])
+    print("Counting completed.")
+
+    save_runs(runs, output_name, window if linear else 1, dtype)
+    runs.close()
+
+    csrformat.set_upper(output_name, upper)
 
-        for j in range(len(sentence)):
-            target_id = sentence[j]
+    Vocabulary.from_words(word for word, _ in sorted_vocab).save(output_name)
 
-            for k in range(window):
 
-                q = j + 1 + k
-                if q >= len(sentence):
-                    break
-                context_id = sentence[q]
+def corpus_key(corpus):
+    """
+    Identifies a `LineCorpus` by its file (path, size, mtime),
+    returns None for other corpora
+    """
+
+    if not isinstance(corpus, LineCorpus):
+        return None
+    if corpus.beg != 0 or corpus.end is not None:
+        return None
+
+    stat = os.stat(corpus.file_name)
+    return os.path.abspath(corpus.file_name), stat.st_size, stat.st_mtime
 
-                if ind >= max_ind:
-                    m = coo_matrix(
-                        (np.concatenate([m.data, vals]),
-                         (np.concatenate([m.row, rows]),
-                          np.concatenate([m.col, cols]))),
-                        shape=shape, dtype=np.float64,
-                    )
-                    m.sum_duplicates()
-                    ind = 0
 
-                rows[ind] = target_id
-                cols[ind] = context_id
-                vals[ind] = weights[k]
-                ind += 1
+def save_vocab(file_name, vocab, corpus=None):
+    """
+    Saves word counts (before `min_count` pruning) together with
+    the key of the corpus they come from
+    """
+    with open(file_name, "w") as f:
+        pickle.dump(dict(corpus=corpus_key(corpus), counts=dict(vocab)), f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_vocab(file_name, corpus=None):
+    """
+    Loads word counts saved by `save_vocab`
+
+    If `corpus` is given, returns None unless the counts come from it
+    (and it did not change since), or if it cannot be identified.
+    """
+
+    if corpus is not None:
+        key = corpus_key(corpus)
+        if key is None or not os.path.exists(file_name):
+            return None
+
+    with open(file_name) as f:
+        saved = pickle.load(f)
+
+    if corpus is not None and saved["corpus"] != key:
+        return None
+
+    return saved["counts"]
+
+
+def count_corpus(corpus, word2i, runs, window, upper=False, linear=False):
+
+    batch = []
+    for i, sentence in enumerate(corpus):
+        batch.append([word2i[w] for w in sentence if w in word2i])
+
+        if len(batch) == BATCH_SIZE:
+            count_batch(batch, runs, window, upper, linear)
+            batch = []
 
         if i % REPORT_DELAY == 0:
             print("Sentence #%i" % i)
 
-    m = coo_matrix(
-        (np.concatenate([m.data, vals[:ind]]),
-         (np.concatenate([m.row, rows[:ind]]),
-          np.concatenate([m.col, cols[:ind]]))),
-        shape=shape, dtype=np.float64
+    count_batch(batch, runs, window, upper, linear)
+
+
+def count_batch(sentences, runs, window, upper=False, linear=False):
+    """
+    Adds weighted co-occurrences within `sentences` (lists of word ids)
+
+    A context at distance `d` has weight `(window - d + 1) // window`
+    (i.e. 1 for adjacent words, 0 for the others), or with `linear`,
+    `(window - d + 1) / window`.  Only the integer numerators are
+    summed, so that the sums are exact and do not depend on the order
+    of counting (see `save_runs`).
+
+    Both (target, context) and (context, target) cells are counted
+    to make the context window and the matrix symmetric.  With `upper`,
+    both are counted in the one of the upper triangle.
+    """
+
+    lens = [len(sentence) for sentence in sentences]
+    if sum(lens) == 0:
+        return
+
+    ids = np.fromiter(
+        (word_id for sentence in sentences for word_id in sentence),
+        dtype=np.int64, count=sum(lens)
     )
-    m.sum_duplicates()
+    sentence_ids = np.repeat(np.arange(len(lens)), lens)
+
+    for d in range(1, window + 1):
+        if d >= len(ids):
+            break
+
+        weight = window - d + 1 if linear else (window - d + 1) // window
+        if weight == 0:
+            continue
+
+        # Pairs at distance `d` within the same sentence
+        same = sentence_ids[d:] == sentence_ids[:-d]
+        targets, contexts = ids[:-d][same], ids[d:][same]
+
+        if upper:
+            weights = np.empty((len(targets), ), dtype=np.int64)
+            weights.fill(weight)
+            weights[targets == contexts] *= 2  # (both on the diagonal)
+            runs.add(
+                encode(np.minimum(targets, contexts),
+                       np.maximum(targets, contexts)),
+                weights
+            )
+            continue
+
+        weights = np.empty((2 * len(targets), ), dtype=np.int64)
+        weights.fill(weight)
+        runs.add(
+            np.concatenate([encode(targets, contexts),
+                            encode(contexts, targets)]),
+            weights
+        )
+
+
+def save_runs(runs, output_name, denominator, dtype=np.float64):
+    """
+    Merges the runs into [OUTPUT_NAME]-{rows,cols,vals}.npy files,
+    values are the summed numerators divided by `denominator`
+    """
 
-    print("Counting completed.")
+    rows = ArrayWriter(output_name + "-rows.npy", np.int32, runs.directory)
+    cols = ArrayWriter(output_name + "-cols.npy", np.int32, runs.directory)
+    vals = ArrayWriter(output_name + "-vals.npy", dtype, runs.directory)
 
-    # Make the context window and the matrix symmetric
-    m_csr = csr_matrix(m)
-    m = coo_matrix(m_csr + m_csr.transpose())
+    for keys, weights in runs.merge():
+        chunk_rows, chunk_cols = decode(keys)
+        rows.append(chunk_rows)
+        cols.append(chunk_cols)
+        vals.append(weights / float(denominator))
 
-    np.save(output_name + "-rows.npy", m.row)
-    np.save(output_name + "-cols.npy", m.col)
-    np.save(output_name + "-vals.npy", m.data)
+    for writer in (rows, cols, vals):
+        writer.close()
 
-    with open(output_name + "-target2i.pickle", "w") as f:
-        pickle.dump(word2i, f)
 
+# Multiprocessing
+# ------------------------------------------------------------------------------
 
-def main():
 
-    if len(sys.argv) != 5:
-        sys.stderr.write("Usage: python coocs.py "
-                         "CORPUS_FILE OUTPUT_NAME MIN_COUNT WINDOW_SIZE\n")
-        sys.exit(1)
+def _vocab_worker(shard, state):
+    file_name, beg, end = shard
+    return dict(corpus2vocab(LineCorpus(file_name, beg, end)))
 
-    corpus_file = sys.argv[1]
-    output_name = sys.argv[2]
-    min_count = int(sys.argv[3])
-    window_size = int(sys.argv[4])
 
-    corpus = LineCorpus(corpus_file)
+def _count_worker(shard, state):
+    """
+    Counts a shard into sorted runs and returns their paths
+    """
+
+    file_name, beg, end = shard
+
+    runs = SortedRuns(state["memory"], state["directory"])
+    count_corpus(LineCorpus(file_name, beg, end), state["word2i"], runs,
+                 state["window"], state["upper"], state["linear"])
+    runs.spill()
+
+    return runs.runs
+
+
+def same_output(name_a, name_b):
+    """
+    Checks whether two outputs of `count_coocs` are identical
+    """
+
+    for suffix in ("-rows.npy", "-cols.npy", "-vals.npy"):
+        if not np.array_equal(np.load(name_a + suffix, mmap_mode="r"),
+                              np.load(name_b + suffix, mmap_mode="r")):
+            return False
+
+    if csrformat.is_upper(name_a) != csrformat.is_upper(name_b):
+        return False
+
+    return Vocabulary.load(name_a) == Vocabulary.load(name_b)
+
+
+def main():
 
-    count_coocs(corpus, output_name, min_count, window_size)
+    parser = argparse.ArgumentParser(
+        description="Builds a word-word co-occurrence matrix.")
+    parser.add_argument("corpus_file", metavar="CORPUS_FILE")
+    parser.add_argument("output_name", metavar="OUTPUT_NAME")
+    parser.add_argument("min_count", metavar="MIN_COUNT", type=int)
+    parser.add_argument("window_size", metavar="WINDOW_SIZE", type=int)
+    parser.add_argument("--memory", type=int, default=MEMORY // 10**6,
+                        help="memory budget for counting in MB")
+    parser.add_argument("--tmp-dir", default=None,
+                        help="directory for temporary sorted runs")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="nb of counting processes")
+    parser.add_argument("--vocab", default=None,
+                        help="precomputed vocabulary file (see `save_vocab`)")
+    parser.add_argument("--cache-vocab", action="store_true",
+                        help="keep the vocabulary in CORPUS_FILE%s and "
+                             "reuse it in subsequent runs" % VOCAB_SUFFIX)
+    parser.add_argument("--dtype", default="float64",
+                        choices=("float32", "float64"),
+                        help="dtype of the values")
+    parser.add_argument("--upper", action="store_true",
+                        help="store only the upper triangle of the "
+                             "(symmetric) matrix")
+    parser.add_argument("--linear", action="store_true",
+                        help="weight contexts by their distance "
+                             "(by default, just adjacent words count)")
+    parser.add_argument("--check", action="store_true",
+                        help="with --workers, count also in a single process "
+                             "and check that the outputs are identical")
+    args = parser.parse_args()
+
+    corpus = LineCorpus(args.corpus_file)
+
+    count_coocs(corpus, args.output_name, args.min_count, args.window_size,
+                memory=args.memory * 10**6, tmp_dir=args.tmp_dir,
+                workers=args.workers, vocab=args.vocab,
+                cache_vocab=args.cache_vocab, dtype=args.dtype,
+                upper=args.upper, linear=args.linear)
+
+    if args.check and args.workers > 1:
+        check_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+        check_name = os.path.join(check_dir, "serial")
+        count_coocs(corpus, check_name, args.min_count, args.window_size,
+                    memory=args.memory * 10**6, tmp_dir=args.tmp_dir,
+                    vocab=args.vocab, cache_vocab=args.cache_vocab,
+                    dtype=args.dtype, upper=args.upper,
+                    linear=args.linear)
+        identical = same_output(args.output_name, check_name)
+        shutil.rmtree(check_dir)
+
+        if not identical:
+            sys.stderr.write("Parallel and serial outputs differ!\n")
+            sys.exit(1)
+        print("Parallel and serial outputs are identical.")
 
 
 if __name__ == "__main__":
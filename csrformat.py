@@ -0,0 +1,196 @@
+#!/usr/bin/python
+"""
+Native CSR Matrix Format
+========================
+
+A target-context matrix stored directly in the CSR layout:
+
+    [NAME]-csr-indptr.npy   # row pointers
+    [NAME]-csr-indices.npy  # col indices (sorted within each row)
+    [NAME]-csr-data.npy     # values
+    [NAME]-csr-shape.npy    # (nb of rows, nb of cols)
+
+and a vocabulary sorted by indices (see `vocab.py`):
+
+    [NAME]-vocab-*.npy
+
+Unlike the COO files written by `coocs.py` and `wm2thes.py`, these
+may be opened memory-mapped, i.e. without any copying or sorting.
+Several processes opening the same matrix share the page cache.
+
+A symmetric matrix may be stored as its upper triangle (in either
+format), which is marked by an empty file:
+
+    [NAME]-upper
+
+To convert an existing matrix, run:
+
+    python csrformat.py NAME [DTYPE]
+
+DTYPE (e.g. float32) converts the values as well.
+"""
+
+import os
+import sys
+import numpy as np
+
+from scipy.sparse import csr_matrix
+
+# Local imports
+import vocab
+from vocab import Vocabulary
+
+
+SUFFIX = "-csr-"
+ARRAYS = ("indptr", "indices", "data", "shape")
+UPPER = "-upper"
+
+
+def exists(name):
+    return vocab.exists(name) and all(
+        os.path.exists(name + SUFFIX + array + ".npy") for array in ARRAYS
+    )
+
+
+def is_upper(name):
+    """
+    Whether matrix [NAME] is stored as its upper triangle
+    """
+    return os.path.exists(name + UPPER)
+
+
+def set_upper(name, upper):
+    """
+    Marks (or unmarks) matrix [NAME] as stored as its upper triangle
+    """
+    if upper:
+        open(name + UPPER, "w").close()
+    elif is_upper(name):
+        os.remove(name + UPPER)
+
+
+def expand_upper(m):
+    """
+    Returns the symmetric csr_matrix whose upper triangle is
+    the square csr_matrix `m` (with sorted indices)
+
+    Row i of the result is row i of the strict lower triangle followed
+    by row i of `m`, so both are just interleaved (no sorting).
+    """
+
+    n = m.shape[0]
+    rows = np.repeat(np.arange(n), np.diff(m.indptr))
+    strict = m.indices != rows
+
+    # Strict lower triangle (by transposing the strict upper one)
+    lower = csr_matrix(
+        (m.data[strict], m.indices[strict],
+         np.concatenate([[0], np.cumsum(np.bincount(rows[strict],
+                                                    minlength=n))])),
+        shape=(n, n)
+    ).T.tocsr()
+    del rows, strict
+
+    lower_lens, upper_lens = np.diff(lower.indptr), np.diff(m.indptr)
+    nnz = lower.nnz + m.nnz
+    index_dtype = np.int32 if max(nnz, n) < 2**31 else np.int64
+
+    indptr = np.zeros((n + 1, ), dtype=index_dtype)
+    np.cumsum(lower_lens + upper_lens, out=indptr[1:])
+    indices = np.empty((nnz, ), dtype=index_dtype)
+    data = np.empty((nnz, ), dtype=m.dtype)
+
+    for part, offsets in ((lower, indptr[:-1]),
+                          (m, indptr[:-1] + lower_lens)):
+        lens = np.diff(part.indptr)
+        pos = np.arange(part.nnz) + np.repeat(offsets - part.indptr[:-1],
+                                              lens)
+        indices[pos] = part.indices
+        data[pos] = part.data
+
+    full = csr_matrix((data, indices, indptr), shape=(n, n), copy=False)
+    full.has_sorted_indices = True
+
+    return full
+
+
+def save_csr(name, m, vocabulary):
+    """
+    Saves csr_matrix `m` and its `vocab.Vocabulary`
+    """
+
+    m.sum_duplicates()  # also sorts indices
+
+    # int32 indices are both smaller and kept as they are by scipy
+    index_dtype = (
+        np.int32 if max(m.nnz, m.shape[1]) < 2**31 else np.int64
+    )
+
+    np.save(name + SUFFIX + "indptr.npy", m.indptr.astype(index_dtype))
+    np.save(name + SUFFIX + "indices.npy", m.indices.astype(index_dtype))
+    np.save(name + SUFFIX + "data.npy", m.data)
+    np.save(name + SUFFIX + "shape.npy", np.array(m.shape, dtype=np.int64))
+
+    vocabulary.save(name)
+
+
+def load_csr(name, mmap_mode="r"):
+    """
+    Returns (csr_matrix, vocab.Vocabulary)
+
+    With the default `mmap_mode`, arrays of the matrix are read-only
+    memory maps.  Copy `data` before modifying it in place.
+    """
+
+    indptr, indices, data, shape = (
+        np.load(name + SUFFIX + array + ".npy", mmap_mode=mmap_mode)
+        for array in ARRAYS
+    )
+
+    m = csr_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+    m.has_sorted_indices = True
+
+    return m, Vocabulary.load(name, mmap_mode=mmap_mode)
+
+
+def convert(name, dtype=None):
+    """
+    Converts [NAME]-{rows,cols,vals}.npy to the native format
+
+    The vocabulary is converted from [NAME]-target2i.pickle
+    if there is not [NAME]-vocab-*.npy yet
+
+    If `dtype` is given, values are converted to it
+    """
+
+    # Not memory-mapped, as `save_csr` rewrites it
+    vocabulary = vocab.load(name, mmap_mode=None)
+
+    rows = np.load(name + "-rows.npy")
+    cols = np.load(name + "-cols.npy")
+    vals = np.load(name + "-vals.npy", mmap_mode="r")
+    vals = np.array(vals, dtype=dtype or vals.dtype)
+
+    shape = (
+        max(len(vocabulary), rows.max() + 1 if len(rows) else 0),
+        cols.max() + 1 if len(cols) else 0
+    )
+    if is_upper(name):
+        shape = (max(shape), ) * 2
+    m = csr_matrix((vals, (rows, cols)), shape=shape)
+    del rows, cols, vals
+
+    save_csr(name, m, vocabulary)
+
+
+def main():
+
+    if len(sys.argv) not in (2, 3):
+        sys.stderr.write("Usage: python csrformat.py NAME [DTYPE]\n")
+        sys.exit(1)
+
+    convert(*sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
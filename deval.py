@@ -3,6 +3,15 @@ from copy import deepcopy
 
 # Local imports
 from formulas import add as default_formula
+from simcache import DiskCache
+
+
+# Nb of query words whose similarities are computed at once
+# (peak memory of such a block is BLOCK_SIZE x vocab floats)
+BLOCK_SIZE = 256
+
+# Size of a sample of scores used to prune candidates in `top_indices`
+SAMPLE_SIZE = 1024
 
 
 class DiMo(object):
@@ -21,6 +30,71 @@ class DiMo(object):
         # We may at least cache them
         self.cached_sims = dict()
 
+        # Optional precomputed neighbours (see `topk.py`)
+        self.topk = None
+
+        # Optional approximate nearest neighbours index (see `ann.py`)
+        self.ann = None
+        self.rerank = 10
+
+    def use_topk(self, index):
+        """
+        Serves `most_similar` (of a single word) from `topk.TopKIndex`
+        """
+        self.topk = index
+
+    def _sims_dtype(self):
+        """
+        Returns the dtype of computed similarities, which scores of
+        `topk` are converted to (None to keep them as they are stored)
+        """
+        return None
+
+    def use_ann(self, index, rerank=10):
+        """
+        Enables `most_similar(..., approximate=True)` with `ann.IVFIndex`
+
+        Exact similarities are computed for `rerank` * topn candidates
+        closest by the vectors of the index.
+        """
+        self.ann = index
+        self.rerank = rerank
+
+    def use_cache(self, cache):
+        """
+        Replaces the unbounded `cached_sims` dictionary by a dict-like
+        `cache`, e.g. `simcache.SimilarityCache` with a memory budget
+        """
+        self.cached_sims = cache
+
+    def use_disk_cache(self, directory, dtype=np.float32):
+        """
+        Caches similarities in `directory` (see `simcache.DiskCache`),
+        so they are shared by all sessions and processes using the model
+        """
+        self.use_cache(DiskCache(directory, self.model_key(), dtype))
+
+    def model_key(self):
+        """
+        Returns a key identifying the model (its files and settings)
+        """
+        raise NotImplementedError
+
+    def _sims(self, word):
+        """
+        Returns similarities of `word` from the cache, computing
+        (and caching) them if they are missing
+        """
+        try:
+            return self.cached_sims[word]
+        except KeyError:
+            sims = self.similarities(word)
+            self.cached_sims[word] = sims
+
+            # As the cache returns it, whether it is kept or evicted
+            stored = getattr(self.cached_sims, "stored", None)
+            return sims if stored is None else stored(sims)
+
     def similarity(self, a, b):
         """
         Returns similarity of two words
@@ -37,8 +111,25 @@ class DiMo(object):
         """
         raise NotImplementedError
 
+    def similarities_many(self, words):
+        """
+        Returns a dense (len(words), vocab) matrix where the k-th row is
+        the vector of similarities of the k-th word to the whole vocabulary
+
+        Subclasses may override this with a batched computation
+        """
+        return np.vstack([self.similarities(word) for word in words])
+
+    def similarities_to(self, word, ids):
+        """
+        Returns vector of similarities of a given word to words `ids`
+
+        Subclasses may override this to avoid computing all similarities
+        """
+        return self.similarities(word)[ids]
+
     def eval_analogy(self, dataset, topn=1, exclusion_trick=True,
-                     formula=default_formula):
+                     formula=default_formula, batch_size=None):
         """
         Evaluates the model on the given dataset.
 
@@ -47,6 +138,20 @@ class DiMo(object):
 
         A query is supposed to look like this
             ("paris", "france", "london", {"england", "britain", "uk"})
+
+        If `batch_size` is given, queries are solved in blocks of this
+        size: `formula` is applied on (batch_size, vocab) matrices and
+        candidates are selected and checked for the whole block at once.
+
+        With the exclusion trick, scores of the query words (unless they
+        are correct answers) are masked to -inf before the `topn`
+        candidates are selected.  Records of `queries` still list the
+        `topn + 3` best candidates of the unmasked scores, with the
+        position of the correct answer among the `topn` selected ones
+        (`topn` if it is not there).
+
+        With a bounded cache (see `use_cache`), similarities are cached
+        for blocks of queries rather than for the whole dataset.
         """
 
         results = {
@@ -60,78 +165,221 @@ class DiMo(object):
             for category_label in dataset
         }
 
-        self._cache_sims_for_dataset(dataset)
+        # A bounded cache could not hold the whole dataset, so it is
+        # filled block by block, in an order reusing cached words
+        bounded = getattr(self.cached_sims, "max_bytes", None) is not None
+        if not bounded:
+            self._cache_sims_for_dataset(dataset)
 
         for cat, queries in dataset.items():
 
-            for a, b, aa, bbs in queries:
+            if bounded:
+                order = _reuse_order(queries)
+                block_size = batch_size or BLOCK_SIZE
+            else:
+                order = list(range(len(queries)))
+                block_size = max(1, len(queries))
 
-                assert type(bbs) == set
+            entries = []  # (index of query, query with candidates)
 
-                excl_set = {a, aa, b}  # for exclusion trick
+            for beg in range(0, len(order), block_size):
+                block = [(k, queries[k]) for k in order[beg:beg + block_size]]
 
-                if a not in self.cached_sims:
-                    results[cat]["oovs"].add(a)
-                if b not in self.cached_sims:
-                    results[cat]["oovs"].add(b)
-                if aa not in self.cached_sims:
-                    results[cat]["oovs"].add(aa)
+                if bounded:
+                    self._cache_sims_for_queries([q for __, q in block])
 
-                try:
-                    sims_a = self.cached_sims[a]
-                    sims_b = self.cached_sims[b]
-                    sims_aa = self.cached_sims[aa]
-                except KeyError:
-                    results[cat]["oov"] += 1
-                    continue
+                if batch_size is not None:
+                    self._eval_batched(block, results[cat], entries, topn,
+                                       exclusion_trick, formula, batch_size)
+                else:
+                    self._eval_queries(block, results[cat], entries, topn,
+                                       exclusion_trick, formula)
 
-                scores = formula(sims_a, sims_b, sims_aa)
-                cand_ids = np.argsort(scores)[::-1][:topn+3]
-                cands = [self.i2word[cand_id] for cand_id in cand_ids]
+            # Queries with candidates in the original order
+            entries.sort(key=lambda entry: entry[0])
+            results[cat]["queries"] = [query for __, query in entries]
 
-                correct_pos = topn
+            # After all queries are processed:
+            results[cat]["acc"] /= float(len(dataset[cat]))
+            results[cat]["acc_top1"] /= float(len(dataset[cat]))
 
-                #
-                # Interpreting Results:
-                #
-                # correct_pos == 0
-                #   ===>  the first candidate is the correct answer
-                # correct_pos >= topn
-                #   ===>  correct answer not found within topn
-                #
+        return results
 
-                pos = 0
-                for cand in cands:
+    def _eval_queries(self, queries, result, entries, topn, exclusion_trick,
+                      formula):
+        """
+        Part of `eval_analogy` solving (index, query) pairs one by one
+        """
 
-                    if cand in bbs:
-                        correct_pos = pos
-                        break
+        for k, (a, b, aa, bbs) in queries:
 
-                    if exclusion_trick is True and cand in excl_set:
-                        continue
-                    if exclusion_trick == "aa" and cand == aa:
-                        continue
+            assert type(bbs) == set
 
-                    pos += 1
+            oovs = {w for w in (a, b, aa) if w not in self.word2i}
+            if len(oovs) > 0:
+                result["oovs"].update(oovs)
+                result["oov"] += 1
+                continue
 
-                if correct_pos < topn:
-                    results[cat]["acc"] += 1
+            sims_a = self._sims(a)
+            sims_b = self._sims(b)
+            sims_aa = self._sims(aa)
 
-                if correct_pos < 1:
-                    results[cat]["acc_top1"] += 1
+            scores = formula(sims_a, sims_b, sims_aa)
 
-                results[cat]["queries"].append(
-                    (a, b, aa, cands, correct_pos)
-                )
+            # Exclusion trick: query words are never candidates
+            # (unless they are correct answers)
+            if exclusion_trick is True:
+                excl_set = {a, b, aa} - bbs
+            elif exclusion_trick == "aa":
+                excl_set = {aa} - bbs
+            else:
+                excl_set = set()
+
+            excl_ids = np.array([self.word2i[w] for w in excl_set],
+                                dtype=np.int64)
+            excl_scores = scores[excl_ids]
+            if len(excl_ids) > 0:
+                scores = scores.copy()  # not to mask cached sims
+                scores[excl_ids] = -np.inf
+
+            cand_ids = top_indices(scores, topn + 3)
+            cands = [self.i2word[cand_id] for cand_id in cand_ids[:topn]]
+
+            #
+            # Interpreting Results:
+            #
+            # correct_pos == 0
+            #   ===>  the first candidate is the correct answer
+            # correct_pos >= topn
+            #   ===>  correct answer not found within topn
+            #
+
+            correct_pos = topn
+
+            for pos, cand in enumerate(cands):
+                if cand in bbs:
+                    correct_pos = pos
+                    break
+
+            if correct_pos < topn:
+                result["acc"] += 1
+
+            if correct_pos < 1:
+                result["acc_top1"] += 1
+
+            record_ids = _unmasked_top(cand_ids, scores[cand_ids],
+                                       excl_ids, excl_scores, topn + 3)
+            cands = [self.i2word[cand_id] for cand_id in record_ids]
+            entries.append((k, (a, b, aa, cands, correct_pos)))
+
+    def _eval_batched(self, queries, result, entries, topn, exclusion_trick,
+                      formula, batch_size):
+        """
+        Vectorized part of `eval_analogy` for (index, query) pairs
+        """
 
-            # After all queries are processed:
-            results[cat]["acc"] /= float(len(queries))
-            results[cat]["acc_top1"] /= float(len(queries))
+        valid = []
+        for k, (a, b, aa, bbs) in queries:
 
-        return results
+            assert type(bbs) == set
+
+            oovs = {w for w in (a, b, aa) if w not in self.word2i}
+            if len(oovs) > 0:
+                result["oovs"].update(oovs)
+                result["oov"] += 1
+            else:
+                valid.append((k, (a, b, aa, bbs)))
+
+        if len(valid) == 0:
+            return
+
+        # Buffers for stacked similarities of query words (a, b, aa),
+        # reused by all batches (in the dtype of the model)
+        first = self._sims(valid[0][1][0])
+        stacked = np.empty((3, min(batch_size, len(valid)), len(first)),
+                           dtype=first.dtype)
+
+        word_ids = dict()  # looked up indices (-1 for oov answers)
+
+        for beg in range(0, len(valid), batch_size):
+            indices = [k for k, __ in valid[beg:beg + batch_size]]
+            batch = [query for __, query in valid[beg:beg + batch_size]]
+
+            # Indices of the query words
+            for word in {w for a, b, aa, __ in batch for w in (a, b, aa)}:
+                if word not in word_ids:
+                    word_ids[word] = self.word2i[word]
+            query_ids = np.array(
+                [[word_ids[w] for w in (a, b, aa)] for a, b, aa, __ in batch])
+
+            # Correct answers (in vocab) padded by -1
+            for word in {w for __, __, __, bbs in batch for w in bbs}:
+                if word not in word_ids:
+                    word_ids[word] = self.word2i.get(word, -1)
+            answers = [
+                [word_ids[w] for w in bbs if word_ids[w] >= 0]
+                for __, __, __, bbs in batch
+            ]
+            answer_ids = -np.ones(
+                (len(batch), max([1] + [len(ids) for ids in answers])),
+                dtype=np.int64)
+            for j, ids in enumerate(answers):
+                answer_ids[j, :len(ids)] = ids
+
+            # Similarities of the query words, stacked
+            for j, query in enumerate(batch):
+                for i in range(3):
+                    stacked[i, j] = self._sims(query[i])
+
+            # (a new array, or a view of the buffers, so it may be masked)
+            scores = formula(*stacked[:, :len(batch)])
+
+            # Exclusion trick: query words are never candidates
+            # (unless they are correct answers)
+            if exclusion_trick is True:
+                excl_ids = query_ids
+            elif exclusion_trick == "aa":
+                excl_ids = query_ids[:, 2:]
+            else:
+                excl_ids = query_ids[:, :0]
+
+            excl_ids = np.where(_isin_rows(excl_ids, answer_ids), -1,
+                                excl_ids)
+            rows = np.repeat(np.arange(len(batch)), excl_ids.shape[1])
+            cols = excl_ids.ravel()
+            rows, cols = rows[cols >= 0], cols[cols >= 0]
+            excl_scores = scores[rows, cols]
+            scores[rows, cols] = -np.inf
+
+            cand_ids = top_indices(scores, topn + 3)
+            cand_scores = scores[np.arange(len(batch))[:, np.newaxis],
+                                 cand_ids]
+            del scores
+
+            # Position of the first correct answer
+            hits = _isin_rows(cand_ids[:, :topn], answer_ids)
+            correct_pos = np.where(hits.any(axis=1), hits.argmax(axis=1),
+                                   topn)
+
+            result["acc"] += int(np.sum(correct_pos < topn))
+            result["acc_top1"] += int(np.sum(correct_pos < 1))
+
+            for j, (k, (a, b, aa, __), pos) in enumerate(
+                    zip(indices, batch, correct_pos)):
+                record_ids = _unmasked_top(
+                    cand_ids[j], cand_scores[j], cols[rows == j],
+                    excl_scores[rows == j], topn + 3)
+                cands = [self.i2word[cand_id] for cand_id in record_ids]
+                entries.append((k, (a, b, aa, cands, int(pos))))
 
     def most_similar(self, positive, negative=None, topn=10, method="add",
-                     freq_range=(0, None)):
+                     freq_range=(0, None), approximate=False):
+        """
+        With `approximate`, only candidates found by the index given to
+        `use_ann` are scored (just the "add" method is supported)
+        """
+
         if type(positive) in (str, unicode):
             positive = [positive]
 
@@ -144,6 +392,20 @@ class DiMo(object):
         if _from is None:
             _from = 0
 
+        if approximate:
+            if self.ann is None:
+                raise ValueError("No index, call `use_ann` first.")
+            if method != "add":
+                raise ValueError("Only `add` method may be approximate.")
+            return self._most_similar_approx(positive, negative, topn,
+                                             _from, _to)
+
+        if (self.topk is not None and len(positive) == 1 and not negative
+                and _from == 0 and _to is None and topn <= self.topk.k):
+            ids, scores = self.topk.neighbours(self.word2i[positive[0]], topn)
+            scores = scores.astype(self._sims_dtype() or scores.dtype)
+            return [(self.i2word[i], s) for i, s in zip(ids, scores)]
+
         sims = {}
         for word in positive + negative:
             assert word in self.word2i
@@ -168,21 +430,195 @@ class DiMo(object):
             raise ValueError("`method` argument must be `add` or `mul`")
 
         scores = scores[_from:_to]
-        indices = np.argsort(scores)[::-1][:topn]
+        indices = top_indices(scores, topn)
 
         return [(self.i2word[i + _from], scores[i]) for i in indices]
 
-    def _cache_sims_for_dataset(self, dataset):
+    def _most_similar_approx(self, positive, negative, topn, _from, _to):
+
+        pos_ids = [self.word2i[word] for word in positive]
+        neg_ids = [self.word2i[word] for word in negative]
+
+        # The same combination of unit vectors as of similarities
+        points = self.ann.points
+        query = points[pos_ids].sum(axis=0)
+        if len(neg_ids) > 0:
+            query -= points[neg_ids].sum(axis=0)
+
+        cands = self.ann.candidates(query)
+
+        _from, _to, __ = slice(_from, _to).indices(len(self.i2word))
+        cands = cands[(cands >= _from) & (cands < _to)]
+
+        if len(cands) > self.rerank * topn:
+            cands = cands[top_indices(points[cands].dot(query),
+                                      self.rerank * topn)]
+
+        scores = sum(self.similarities_to(word, cands) for word in positive)
+        for word in negative:
+            scores = scores - self.similarities_to(word, cands)
+
+        top = top_indices(scores, topn)
+
+        return [(self.i2word[cands[k]], scores[k]) for k in top]
+
+    def _cache_sims_for_dataset(self, dataset, block_size=BLOCK_SIZE):
+        self._cache_sims_for_queries(
+            [query for queries in dataset.values() for query in queries],
+            block_size
+        )
+
+    def _cache_sims_for_queries(self, queries, block_size=BLOCK_SIZE):
         words = set()
 
-        for queries in dataset.values():
-            for a, b, aa, __ in queries:
-                for word in (a, b, aa):
-                    words.add(word)
+        for a, b, aa, __ in queries:
+            for word in (a, b, aa):
+                words.add(word)
+
+        # Sorted by indices, so that a block reads neighbouring rows
+        words = sorted(
+            (word for word in words
+             if word in self.word2i and word not in self.cached_sims),
+            key=lambda word: self.word2i[word]
+        )
+
+        for beg in range(0, len(words), block_size):
+            block = words[beg:beg + block_size]
+            sims = self.similarities_many(block)
+            for word, word_sims in zip(block, sims):
+                self.cached_sims[word] = word_sims
+
+
+def _reuse_order(queries):
+    """
+    Returns indices of `queries` ordered so that neighbouring queries
+    share their words: grouped by (a, b) and sorted by `aa` within
+    a group, every other group reversed (so its first `aa` is the last
+    one of the previous group)
+    """
+
+    groups = dict()
+    for k, (a, b, __, __) in enumerate(queries):
+        groups.setdefault((a, b), []).append(k)
+
+    order = []
+    for g, key in enumerate(sorted(groups)):
+        group = sorted(groups[key], key=lambda k: queries[k][2])
+        order.extend(group[::-1] if g % 2 else group)
+
+    return order
+
+
+def _isin_rows(ids, sets):
+    """
+    For 2d arrays `ids` and `sets` (rows padded by -1), returns mask
+    of `ids` such that `ids[k, j]` is in `sets[k]`
+    """
+    return (ids[:, :, np.newaxis] == sets[:, np.newaxis, :]).any(axis=2)
+
+
+def _unmasked_top(cand_ids, cand_scores, excl_ids, excl_scores, n):
+    """
+    Merges masked `excl_ids` back into the candidates (sorted by
+    decreasing scores), returns the first `n` ids, i.e. the top `n`
+    of the unmasked scores (if candidates are at least `n`)
+    """
+
+    keep = ~np.in1d(cand_ids, excl_ids)
+    cand_ids, cand_scores = cand_ids[keep], cand_scores[keep]
+
+    # (query words may repeat)
+    excl_ids, first = np.unique(excl_ids, return_index=True)
+    excl_scores = excl_scores[first]
+
+    order = np.argsort(-excl_scores, kind="mergesort")
+    excl_ids, excl_scores = excl_ids[order], excl_scores[order]
+
+    pos = np.searchsorted(-cand_scores, -excl_scores, side="right")
+    return np.insert(cand_ids, pos, excl_ids)[:n]
+
+
+def top_indices(scores, n):
+    """
+    Returns indices of the `n` highest scores in decreasing order
+
+    For a 2d array, this is done for each row.  Only these `n` scores
+    are sorted (after a partial selection of them).  Each row is
+    processed on its own, so its result does not depend on the others.
+    """
+
+    length = scores.shape[-1]
+    n = min(n, length)
+
+    if n <= 0:
+        return np.zeros(scores.shape[:-1] + (0, ), dtype=np.int64)
+
+    stride = length // SAMPLE_SIZE
+    if stride < 4 or 4 * n > SAMPLE_SIZE:
+        return _top_indices_partition(scores, n)
+
+    matrix = np.atleast_2d(scores)
+    ids, done = _top_indices_sampled(matrix, n, stride)
+
+    rest = np.flatnonzero(~done)
+    if len(rest) == len(matrix):
+        ids = _top_indices_partition(matrix, n)
+    elif len(rest) > 0:
+        ids[rest] = _top_indices_partition(matrix[rest], n)
+
+    return ids if scores.ndim > 1 else ids[0]
+
+
+def _top_indices_partition(scores, n):
+
+    length = scores.shape[-1]
+    ids = np.argpartition(scores, length - n, axis=-1)[..., length - n:]
+    order = np.argsort(np.take_along_axis(scores, ids, axis=-1), axis=-1)
+
+    return np.take_along_axis(ids, order[..., ::-1], axis=-1)
+
+
+def _top_indices_sampled(matrix, n, stride):
+    """
+    `top_indices` of the rows of 2d `matrix` which it suits,
+    returns (ids, mask of these rows)
+
+    The n-th highest score of a strided sample of a row is a lower
+    bound of the n-th highest score of the whole row, so only the few
+    scores above it (about `n * stride`) need to be selected from.
+    Rows with NaNs or with many more scores above the bound are left
+    out, e.g. sparse rows (the bound is their minimum 0 there).
+    """
+
+    sample = matrix[:, ::stride]
+    bounds = np.partition(sample, sample.shape[1] - n, axis=1)[:, -n]
+
+    with np.errstate(invalid="ignore"):  # (NaNs)
+        done = bounds > sample.min(axis=1)
+        rows = np.flatnonzero(done)
+        sub = matrix if len(rows) == len(matrix) else matrix[rows]
+        above = sub >= bounds[rows, np.newaxis]
+
+    ok = (
+        (np.count_nonzero(above, axis=1) <= 4 * n * stride)
+        & ~np.isnan(sub).any(axis=1)
+    )
+    if not ok.all():
+        above[~ok] = False
+        done[rows[~ok]] = False
+
+    cells = np.flatnonzero(above)
+    sub_rows, cols = cells // matrix.shape[1], cells % matrix.shape[1]
+
+    # Sorted by rows, then by decreasing scores
+    order = np.lexsort((-sub[sub_rows, cols], sub_rows))
+    sub_rows, cols = sub_rows[order], cols[order]
+
+    ids = np.zeros((matrix.shape[0], n), dtype=np.int64)
+    starts = np.searchsorted(sub_rows, np.flatnonzero(ok))
+    ids[done] = cols[starts[:, np.newaxis] + np.arange(n)]
 
-        for word in words:
-            if word in self.word2i and word not in self.cached_sims:
-                self.cached_sims[word] = self.similarities(word)
+    return ids, done
 
 
 def pairs2queries(pairs, fa=lambda w: w, fb=lambda w: w):
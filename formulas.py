@@ -6,6 +6,9 @@ See the section 4.2 for more information on this.
 
 # Each input `a`, `b`, `aa` should be a vector of similarities
 # of corresponding word to the whole vocab
+#
+# Results keep the dtype of the inputs (scalars like `epsilon`
+# do not upcast float32 vectors).
 
 
 def add(a, b, aa):
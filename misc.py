@@ -1,6 +1,10 @@
+import hashlib
+import os
 import pickle
+from functools import partial
 from gzip import open as gzip_open
 from collections import defaultdict
+from multiprocessing import Pool
 
 # ------------------------------------------------------------------------------
 # Openers
@@ -27,18 +31,67 @@ def use_opener(file_path, mode="r"):
 
 class LineCorpus(object):
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, beg=0, end=None):
+        """
+        If `beg` or `end` are given, only lines within this byte range
+        are read (see `split_lines`)
+        """
 
         self.file_name = file_name
+        self.beg = beg
+        self.end = end
 
     def __iter__(self):
 
         with use_opener(self.file_name) as f:
-            for line in f:
+            for line in self._lines(f):
                 sentence = line.strip("\n\r\t ").split()
                 if len(sentence) > 0:
                     yield sentence
 
+    def _lines(self, f):
+
+        if self.beg == 0 and self.end is None:
+            return f
+
+        return _read_range(f, self.beg, self.end)
+
+
+def _read_range(f, beg, end):
+
+    f.seek(beg)
+    pos = beg
+
+    while end is None or pos < end:
+        line = f.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
+
+
+def split_lines(file_name, nb_parts):
+    """
+    Splits a plain text file into `nb_parts` byte ranges [beg, end)
+    of roughly the same size, each starting at the beginning of a line
+    """
+
+    if get_opener(file_name) is not open:
+        raise ValueError("Only plain text files can be split: " + file_name)
+
+    size = os.path.getsize(file_name)
+    offsets = [0]
+
+    with open(file_name) as f:
+        for k in range(1, nb_parts):
+            f.seek(max(offsets[-1], size * k // nb_parts))
+            f.readline()
+            offsets.append(f.tell())
+
+    offsets.append(size)
+
+    return [(beg, end) for beg, end in zip(offsets, offsets[1:]) if beg < end]
+
 
 def corpus2vocab(corpus):
 
@@ -57,13 +110,99 @@ def dump_sentences(sentences, output_file):
             f.write(" ".join(sentence) + "\n")
 
 # ------------------------------------------------------------------------------
+# Keys for cached artifacts
+#
 
 
-def save_report(report, dataset_name, model_name, formula, directory="reports/"):
+def files_key(file_names):
+    """ Identifies existing files by (path, size, mtime). """
+    return [
+        (os.path.abspath(name), os.path.getsize(name), os.path.getmtime(name))
+        for name in sorted(file_names)
+        if os.path.exists(name)
+    ]
+
+
+def function_key(function):
+    """
+    Identifies a named function or a `functools.partial` of it
+    (lambdas cannot be identified)
+    """
+
+    if function is None:
+        return None
+
+    if isinstance(function, partial):
+        return (function_key(function.func), function.args,
+                sorted((function.keywords or {}).items()))
+
+    if function.__name__ == "<lambda>":
+        raise ValueError("Cannot identify a lambda, "
+                         "use a named function or functools.partial.")
+
+    return function.__module__, function.__name__
+
+
+def digest(key):
+    return hashlib.sha1(repr(key)).hexdigest()[:16]
+
+# ------------------------------------------------------------------------------
+# Forked workers
+#
+
+_worker_state = dict()
+
+
+def imap_forked(function, jobs, workers=1, **state):
+    """
+    Yields results of `function(job, state)` for `jobs` (in any order)
+
+    With `workers` > 1, jobs run in forked processes, which inherit
+    the `state` (e.g. a model) instead of getting it pickled.  Only one
+    such loop may run at a time.
+    """
+
+    _worker_state.update(state)
+
+    pool = Pool(workers) if workers > 1 else None
+
+    try:
+        if pool is None:
+            for job in jobs:
+                yield function(job, _worker_state)
+        else:
+            for result in pool.imap_unordered(
+                    _forked_worker, [(function, job) for job in jobs]):
+                yield result
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _worker_state.clear()
+
+
+def _forked_worker(task):
+    function, job = task
+    return function(job, _worker_state)
+
+
+# ------------------------------------------------------------------------------
+
+
+def report_path(dataset_name, model_name, formula, directory="reports/"):
     parts = [dataset_name, model_name, formula]
     name = ".".join(parts)
-    with open(directory + "/" + name + ".pickle", "w") as f:
+    return directory + "/" + name + ".pickle"
+
+
+def save_report(report, dataset_name, model_name, formula, directory="reports/"):
+    path = report_path(dataset_name, model_name, formula, directory)
+
+    # Renamed when complete, so an existing report is never partial
+    with open(path + ".tmp", "w") as f:
         pickle.dump(file=f, obj=report)
+    os.rename(path + ".tmp", path)
 
 
 def load_report(name):
@@ -3,15 +3,26 @@
 # This code is not optimized in any special way
 # aside from what was really necessary.
 
-import pickle
+import os
 import numpy as np
 
-from scipy.sparse import csr_matrix
+from glob import glob
+from scipy.sparse import coo_matrix, csr_matrix, csc_matrix
 from sklearn.preprocessing import normalize
 from gensim.models.keyedvectors import KeyedVectors
 
 # Local imports
+import csrformat
+import vocab
 from deval import DiMo
+from misc import files_key, function_key, digest
+from quant import QuantizedMatrix
+from vocab import Vocabulary
+from weightings import NEEDS_MARGINALS, marginals_of
+
+
+# Max. nb of matrix cells visited at once by `SkEThesSKE.similarities`
+SKE_CHUNK = 2 * 10**6
 
 
 class SkEThes(DiMo):
@@ -19,40 +30,171 @@ class SkEThes(DiMo):
     Abstract class for SkEThes
         ... or basically for an arbitrary target-context matrix
 
-    Subclasses should implement `similarity` and `similarities` methods.
+    Subclasses should implement `_similarity` and `similarities` methods.
     """
 
-    def __init__(self, name, weighting=None):
+    def __init__(self, name, weighting=None, cache_dir=None, dtype=None):
         """
         Loads a target-context matrix defined by three files:
             [NAME]-rows.npy  # row indices
             [NAME]-cols.npy  # col indices
             [NAME]-vals.npy  # value on corresponding cell
 
-        as well as a dictionary:
+        as well as a vocabulary (see `vocab.py`):
+            [NAME]-vocab-*.npy
+
+        or, for older matrices, a dictionary:
             [NAME]-target2i.pickle
 
+        If the matrix was converted to the native CSR format
+        (see `csrformat.py`), it is memory-mapped instead.
+
         If the matrix contains raw counts, you may consider applying
         some weightings on it (see `weightings.py` file).
+
+        A symmetric matrix stored as its upper triangle (see `coocs.py`)
+        is weighted as such, with marginals of the whole matrix, and
+        expanded afterwards.
+
+        If `cache_dir` is given, the weighted matrix together with all
+        pre-computations of the subclass is saved there.  The next time
+        the same model (same files, class and weighting) is opened, it is
+        just memory-mapped from there.  In this case, `weighting` must
+        be a named function or a `functools.partial` of it.
+
+        If `dtype` is given, values are converted to it when loaded
+        (e.g. np.float32 halves the memory of a float64 matrix and speeds
+        up all the products); weightings and similarities then keep it.
+        By default, the dtype of the files is kept.
         """
 
         self.name = name
+        self.weighting = weighting
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.symmetric = False  # M known to be symmetric
+
+        cache_name = (
+            None if cache_dir is None
+            else os.path.join(cache_dir, "%s-%s-%s" % (
+                os.path.basename(name), type(self).__name__,
+                digest(self._cache_key(weighting))))
+        )
 
-        with open(name + "-target2i.pickle") as f:
-            word2i = pickle.load(f)
+        if cache_name is not None and os.path.exists(cache_name + "-ready"):
+            self.M, self.vocab = csrformat.load_csr(cache_name)
+            self._restore(dict(
+                (array, np.load(cache_name + "-%s.npy" % array, mmap_mode="r"))
+                for array in self.PRECOMPUTED
+            ))
+        else:
+            upper = csrformat.is_upper(name)
+            self._load(name)
+
+            if weighting is not None:
+                self._own_data()
+                func = getattr(weighting, "func", weighting)  # (partials)
+                if upper and func in NEEDS_MARGINALS:
+                    weighting(self.M, marginals=marginals_of(self.M, True))
+                else:
+                    weighting(self.M)
+
+            if upper:
+                self.M = csrformat.expand_upper(self.M)
+                self.symmetric = True
+
+            self._prepare()
+
+            if cache_name is not None:
+                csrformat.save_csr(cache_name, self.M, self.vocab)
+                for array, values in self._precomputed().items():
+                    np.save(cache_name + "-%s.npy" % array, values)
+                open(cache_name + "-ready", "w").close()
+
+        super(SkEThes, self).__init__(self.vocab.word2i, self.vocab.i2word)
 
-        i2word = {i: word for word, i in word2i.items()}
+    def similarity(self, a, b):
+
+        i = (a if type(a) is int else self.word2i[a])
+        j = (b if type(b) is int else self.word2i[b])
 
-        super(SkEThes, self).__init__(word2i, i2word)
+        score = None if self.topk is None else self.topk.similarity(i, j)
+        if score is None:
+            score = self._similarity(i, j)
+
+        # Either way, in the dtype of M (the index stores float32)
+        return self._sims_dtype().type(score)
+
+    def _sims_dtype(self):
+        return self.M.dtype
+
+    def _similarity(self, i, j):
+        """
+        Returns similarity of targets `i` and `j` (indices)
+        """
+        raise NotImplementedError
+
+    def _load(self, name):
+
+        if csrformat.exists(name):
+            self.M, self.vocab = csrformat.load_csr(name)
+            if self.dtype not in (None, self.M.dtype):
+                self.M.data = self.M.data.astype(self.dtype)
+            return
+
+        self.vocab = vocab.load(name)
 
         rows = np.load(name + "-rows.npy")
         cols = np.load(name + "-cols.npy")
-        scores = np.load(name + "-vals.npy")
+        scores = np.load(name + "-vals.npy", mmap_mode="r")
+        scores = np.array(scores, dtype=self.dtype or scores.dtype)
+
+        shape = (
+            (len(self.vocab), ) * 2 if csrformat.is_upper(name) else None
+        )
+        self.M = csr_matrix((scores, (rows, cols)), shape=shape)
 
-        self.M = csr_matrix((scores, (rows, cols)))
+    def model_key(self):
+        return self._cache_key(self.weighting)
 
-        if weighting is not None:
-            weighting(self.M)
+    def _cache_key(self, weighting):
+        sources = [
+            self.name + suffix for suffix in
+            ("-rows.npy", "-cols.npy", "-vals.npy", "-target2i.pickle",
+             csrformat.UPPER)
+        ]
+        sources += glob(self.name + "-vocab-*.npy")
+        sources += glob(self.name + csrformat.SUFFIX + "*.npy")
+
+        return (files_key(sources), type(self).__name__,
+                function_key(weighting), self.dtype and self.dtype.str)
+
+    # Names of arrays returned by `_precomputed`
+    PRECOMPUTED = ()
+
+    def _prepare(self):
+        """
+        Pre-computations on the (weighted) matrix, to be overridden
+        """
+        pass
+
+    def _precomputed(self):
+        """
+        Returns arrays with results of `_prepare` (to be cached)
+        """
+        return dict()
+
+    def _restore(self, arrays):
+        """
+        Restores results of `_prepare` from cached `arrays`
+        """
+        pass
+
+    def _own_data(self):
+        """
+        Makes values of a memory-mapped M writable (by copying them)
+        """
+        if not self.M.data.flags.writeable:
+            self.M.data = np.array(self.M.data)
 
 
 class SkEThesCOS(SkEThes):
@@ -60,37 +202,75 @@ class SkEThesCOS(SkEThes):
     SkEThes using cosine similarity.
     """
 
-    def __init__(self, name, *args, **kwargs):
-        super(SkEThesCOS, self).__init__(name, *args, **kwargs)
+    def _prepare(self):
+        self._own_data()
         normalize(self.M, norm="l2", axis=1, copy=False)
 
-    def similarity(self, a, b):
-        i = (a if type(a) is int else self.word2i[a])
-        j = (b if type(b) is int else self.word2i[b])
+    def _similarity(self, i, j):
         return self.M[i, :].dot(self.M[j, :].transpose())[0, 0]
 
     def similarities(self, word):
         i = (word if type(word) is int else self.word2i[word])
         return self.M.dot(self.M[i, :].transpose()).toarray()[:, 0]
 
+    def similarities_many(self, words):
+        ids = [(w if type(w) is int else self.word2i[w]) for w in words]
+
+        # A single sparse-by-sparse product for all the query rows
+        # (CSR by CSC of the query rows, M itself is not transposed)
+        return self.M.dot(self.M[ids, :].transpose()).T.toarray(order="C")
+
+    def similarities_to(self, word, ids):
+        i = (word if type(word) is int else self.word2i[word])
+        return self.M[ids, :].dot(self.M[i, :].transpose()).toarray()[:, 0]
+
 
 class SkEThesSKE(SkEThes):
     """
     SkEThes implementing the default similarity measure used in Sketch Engine.
     """
 
-    def __init__(self, name, *args, **kwargs):
+    PRECOMPUTED = ("signs", "row_sums", "Mc_indptr", "Mc_indices", "Mc_data")
 
-        super(SkEThesSKE, self).__init__(name, *args, **kwargs)
+    def _prepare(self):
 
         # Some pre-computation:
         self.signs = self.M.sign()
-        self.sums = self.M.sum(axis=1)
+        self.row_sums = np.array(self.M.sum(axis=1, dtype=np.float64),
+                                 dtype=self.M.dtype)[:, 0]
+        self.sums = np.asmatrix(self.row_sums[:, np.newaxis])
+
+        # Column-inverted copy of M (for `similarities`),
+        # a symmetric M is its own
+        self.Mc = (
+            csc_matrix((self.M.data, self.M.indices, self.M.indptr),
+                       shape=self.M.shape, copy=False)
+            if self.symmetric else self.M.tocsc()
+        )
 
-    def similarity(self, a, b):
+    def _precomputed(self):
+        return dict(
+            signs=self.signs.data, row_sums=self.row_sums,
+            Mc_indptr=self.Mc.indptr, Mc_indices=self.Mc.indices,
+            Mc_data=self.Mc.data,
+        )
 
-        i = (a if type(a) is int else self.word2i[a])
-        j = (b if type(b) is int else self.word2i[b])
+    def _restore(self, arrays):
+
+        # `signs` share the structure of M
+        self.signs = csr_matrix(
+            (arrays["signs"], self.M.indices, self.M.indptr),
+            shape=self.M.shape, copy=False
+        )
+        self.row_sums = arrays["row_sums"]
+        self.sums = np.asmatrix(self.row_sums[:, np.newaxis])
+
+        self.Mc = csc_matrix(
+            (arrays["Mc_data"], arrays["Mc_indices"], arrays["Mc_indptr"]),
+            shape=self.M.shape, copy=False
+        )
+
+    def _similarity(self, i, j):
 
         heu = (self.M[i, :] - self.M[j, :]).power(2) / 50
         upper_raw = self.M[i, :] + self.M[j, :] - heu
@@ -103,22 +283,116 @@ class SkEThesSKE(SkEThes):
         return res[0, 0]
 
     def similarities(self, word):
+        i = (word if type(word) is int else self.word2i[word])
+        return self._similarities_block([i])[0]
 
+    def similarities_many(self, words):
+        ids = [(w if type(w) is int else self.word2i[w]) for w in words]
+        return self._similarities_block(ids)
+
+    def similarities_to(self, word, ids):
+        """
+        Visits just the cells of rows `ids` (against a dense copy
+        of the row of `word`), as `_similarities_block` would score them
+        """
+
+        M = self.M
         i = (word if type(word) is int else self.word2i[word])
+        ids = np.asarray(ids, dtype=np.int64)
+
+        row = np.zeros(M.shape[1], dtype=M.dtype)
+        row[M.indices[M.indptr[i]:M.indptr[i + 1]]] = (
+            M.data[M.indptr[i]:M.indptr[i + 1]]
+        )
+
+        # Cells of the rows `ids`: q -- position of the row, j -- context
+        lens = M.indptr[ids + 1] - M.indptr[ids]
+        q = np.repeat(np.arange(len(ids)), lens)
+        pos = _ranges(M.indptr[ids], lens)
+        j, vx = M.indices[pos], M.data[pos]
 
-        # Copy of M where each non-zero cell M[x, j]
-        # is zeroed and removed if M[i, j] == 0
-        Mnz = self.M.multiply(self.signs[i, :])
-        Mnz.eliminate_zeros()
+        # We want only those cells that are non-zero in both, i and x
+        mi = row[j]
+        nz = (mi != 0) & (vx != 0)
+        q, mi, vx = q[nz], mi[nz], vx[nz] * np.sign(mi[nz])
 
-        # Copy of Mnz where each non-zero cell Mnz[x, j]
-        # is equaled to Mnz[i, j].
-        Mi = (Mnz != 0).multiply(self.M[i, :])
+        res = np.bincount(q, weights=mi + vx - (mi - vx) ** 2 / 50,
+                          minlength=len(ids)).astype(M.dtype)
 
-        inn = Mi + Mnz - ((Mi - Mnz).power(2) / 50)
-        res = inn.sum(axis=1) / (self.sums[i] + self.sums)
+        sums = self.row_sums
+        return res / (sums[i] + sums[ids])
+
+    def _similarities_block(self, ids):
+        """
+        Computes similarities of rows `ids` to all rows of M
+
+        Instead of building full-size sparse temporaries, only the cells
+        of the rows sharing a context with the queries are visited
+        (through the column-inverted copy of M).  They are processed
+        in chunks of at most SKE_CHUNK cells, so the memory needed is
+        proportional to the output.  Similarities are computed
+        in the dtype of M.
+        """
 
-        return np.array(res)[:, 0]
+        M, Mc = self.M, self.Mc
+        nb_rows = M.shape[0]
+        ids = np.asarray(ids, dtype=np.int64)
+
+        # Non-zero cells of the query rows:
+        #   q -- position of the query, j -- context, vi -- M[i, j]
+        lens = M.indptr[ids + 1] - M.indptr[ids]
+        q = np.repeat(np.arange(len(ids)), lens)
+        pos = _ranges(M.indptr[ids], lens)
+        j, vi = M.indices[pos], M.data[pos]
+        nz = vi != 0
+        q, j, vi = q[nz], j[nz], vi[nz]
+
+        # Nb of cells in the column of each context
+        col_lens = Mc.indptr[j + 1] - Mc.indptr[j]
+        ends = np.cumsum(col_lens)
+
+        res = np.zeros(len(ids) * nb_rows, dtype=M.dtype)
+
+        beg = 0
+        while beg < len(j):
+            end = max(beg + 1, np.searchsorted(
+                ends, ends[beg] - col_lens[beg] + SKE_CHUNK, side="right"))
+
+            lens = col_lens[beg:end]
+            pos = _ranges(Mc.indptr[j[beg:end]], lens)
+            x = Mc.indices[pos]
+            vx = Mc.data[pos] * np.repeat(np.sign(vi[beg:end]), lens)
+            mi = np.repeat(vi[beg:end], lens)
+            qx = np.repeat(q[beg:end], lens)
+
+            # We want only those cells that are non-zero in both, i and x
+            nz = vx != 0
+            mi, vx, qx, x = mi[nz], vx[nz], qx[nz], x[nz]
+
+            # Repeated cells are summed by the conversion (unlike
+            # `np.bincount`, it keeps the dtype and the chunk size)
+            chunk = coo_matrix(
+                (mi + vx - (mi - vx) ** 2 / 50, (qx, x)),
+                shape=(len(ids), nb_rows)
+            ).tocsr()
+            res[np.repeat(np.arange(len(ids)) * nb_rows,
+                          np.diff(chunk.indptr)) + chunk.indices] += chunk.data
+            beg = end
+
+        res = res.reshape((len(ids), nb_rows))
+        sums = self.row_sums
+        return res / (sums[ids][:, np.newaxis] + sums[np.newaxis, :])
+
+
+def _ranges(begs, lens):
+    """
+    Concatenation of `range(beg, beg + len)` for all the given pairs
+    """
+    lens = np.asarray(lens)
+    if len(lens) == 0:
+        return np.zeros((0, ), dtype=np.int64)
+    offsets = np.repeat(np.cumsum(lens) - lens, lens)
+    return np.repeat(begs, lens) + (np.arange(offsets.size) - offsets)
 
 
 class Word2Vec(DiMo):
@@ -128,23 +402,54 @@ class Word2Vec(DiMo):
     github.com/RaRe-Technologies/gensim/blob/develop/gensim/models/keyedvectors.py
     """
 
-    def __init__(self, name, word2vec_format=False):
+    def __init__(self, name, word2vec_format=False, quantized=False):
+        """
+        If `quantized`, similarities are computed from int8 unit vectors
+        (see `quant.py`)
+        """
+
+        self.name = name
+        self.quantized = quantized
 
         self.model = (
             KeyedVectors.load_word2vec_format(name)
             if word2vec_format else KeyedVectors.load(name).wv
         )
 
-        i2word = {
-            i: self.model.index2word[i]
-            for i in range(len(self.model.vocab))
-        }
-        word2i = {word: i for i, word in i2word.items()}
+        self.vectors = None
+        if quantized:
+            self.model.init_sims()
+            self.vectors = QuantizedMatrix.quantize(self.model.vectors_norm)
+
+        self.vocab = Vocabulary.from_words(
+            self.model.index2word, unicode_words=True)
 
-        super(Word2Vec, self).__init__(word2i, i2word)
+        super(Word2Vec, self).__init__(self.vocab.word2i, self.vocab.i2word)
+
+    def model_key(self):
+        # Gensim may store large arrays in separate files next to `name`
+        sources = [self.name] + glob(self.name + ".*")
+        return files_key(sources), type(self).__name__, self.quantized
+
+    def _unit_vectors(self):
+        """
+        Returns the unit vectors (the same ones `most_similar` uses)
+        or their quantized version
+        """
+
+        if self.vectors is not None:
+            return self.vectors
+
+        self.model.init_sims()
+        return self.model.vectors_norm
 
     def similarity(self, a, b):
 
+        if self.vectors is not None:
+            i = (a if type(a) is int else self.word2i[a])
+            j = (b if type(b) is int else self.word2i[b])
+            return self.vectors[i].dot(self.vectors[j])
+
         a = (a if type(a) is not int else self.i2word[a])
         b = (b if type(b) is not int else self.i2word[b])
 
@@ -152,7 +457,88 @@ class Word2Vec(DiMo):
 
     def similarities(self, word):
 
+        if self.vectors is not None:
+            i = (word if type(word) is int else self.word2i[word])
+            return self.vectors.dot(self.vectors[i])
+
         if word is int:
             word = self.i2word[word]
 
         return self.model.most_similar(word, topn=False)
+
+    def similarities_many(self, words):
+
+        ids = [(w if type(w) is int else self.word2i[w]) for w in words]
+
+        # Dense GEMM over the unit vectors
+        # (which may be quantized, so they are on the left)
+        vectors = self._unit_vectors()
+
+        return np.ascontiguousarray(vectors.dot(vectors[ids].T).T)
+
+    def similarities_to(self, word, ids):
+
+        i = (word if type(word) is int else self.word2i[word])
+        vectors = self._unit_vectors()
+
+        return vectors[ids].dot(vectors[i])
+
+
+class SkEThesSVD(DiMo):
+    """
+    Dense low-rank embedding of a SkEThes matrix (see `svd.py`),
+    similarities are cosine similarities of the embedded targets
+    """
+
+    def __init__(self, name, mmap_mode="r", quantized=False):
+        """
+        If `quantized`, the embedding is used in int8 (see `quant.py`)
+        as saved by `svd.save_embedding` in [NAME]-quant-*.npy; if these
+        are missing or stale, it is quantized in memory
+        """
+
+        self.name = name
+        self.quantized = quantized
+
+        source = name + "-svd-embedding.npy"
+
+        if not quantized:
+            self.vectors = np.load(source, mmap_mode=mmap_mode)
+        else:
+            embedding = np.load(source, mmap_mode="r")
+            self.vectors = (
+                QuantizedMatrix.load(name, mmap_mode=mmap_mode)
+                if QuantizedMatrix.exists(name, source) else None
+            )
+            if self.vectors is None or self.vectors.shape != embedding.shape:
+                self.vectors = QuantizedMatrix.quantize(embedding)
+            del embedding
+
+        self.vocab = Vocabulary.load(name, mmap_mode=mmap_mode)
+
+        super(SkEThesSVD, self).__init__(self.vocab.word2i, self.vocab.i2word)
+
+    def model_key(self):
+        sources = [self.name + "-svd-embedding.npy"]
+        sources += glob(self.name + "-vocab-*.npy")
+        sources += glob(self.name + "-quant-*.npy")
+        return files_key(sources), type(self).__name__, self.quantized
+
+    def similarity(self, a, b):
+
+        i = (a if type(a) is int else self.word2i[a])
+        j = (b if type(b) is int else self.word2i[b])
+
+        return self.vectors[i].dot(self.vectors[j])
+
+    def similarities(self, word):
+        i = (word if type(word) is int else self.word2i[word])
+        return self.vectors.dot(self.vectors[i])
+
+    def similarities_many(self, words):
+        ids = [(w if type(w) is int else self.word2i[w]) for w in words]
+        return np.ascontiguousarray(self.vectors.dot(self.vectors[ids].T).T)
+
+    def similarities_to(self, word, ids):
+        i = (word if type(word) is int else self.word2i[word])
+        return self.vectors[ids].dot(self.vectors[i])
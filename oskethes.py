@@ -3,10 +3,20 @@ Wrapper for original Sketch Engine Thesaurus
     ... + some other stuff involving `manatee` or `wmap` package
 """
 
-from collections import defaultdict
+from glob import glob
+from multiprocessing.pool import ThreadPool
 
-import manatee
-import wmap
+import numpy as np
+
+try:
+    import manatee
+    import wmap
+except ImportError:  # stubs may be given to `OriginalThesaurus`
+    manatee = wmap = None
+
+# Local imports
+from misc import files_key
+from simcache import DiskCache
 
 
 class OutOfVocabError(AttributeError):
@@ -45,60 +55,176 @@ class OriginalThesaurus(object):
     Class that uses the original Sketch Engine Thesaurus
     """
 
-    def __init__(self, corpus_name):
+    # Default score of a word missing among the neighbours
+    MISSING = 0.05
+
+    def __init__(self, corpus_name, corpus=None, thesaurus=None):
+        """
+        `corpus` (a `manatee.Corpus`) and `thesaurus` (a function like
+        `wmap.Thesaurus_f`) may be replaced, e.g. by stubs for tests
+        """
 
-        self.corpus = manatee.Corpus(corpus_name)
+        self.corpus_name = corpus_name
+        self.corpus = (
+            manatee.Corpus(corpus_name) if corpus is None else corpus
+        )
+        self.thesaurus = wmap.Thesaurus_f if thesaurus is None else thesaurus
         self.wsthes = self.corpus.get_conf("WSTHES")
         self.attr = self.corpus.get_attr(self.corpus.get_conf("WSATTR"))
 
-        self.cached_sims = dict()
+        self.cached_sims = NeighbourStore()
+        self.disk_cache = None
+
+    def use_disk_cache(self, directory):
+        """
+        Keeps similarities also in `directory` (see `simcache.DiskCache`),
+        so they are shared by all sessions and processes
+        """
+        self.disk_cache = DiskCache(directory, self.model_key())
+
+    def model_key(self):
+        return (
+            self.corpus_name, files_key(glob(self.wsthes + "*")),
+            type(self).__name__
+        )
 
     def similarities(self, word):
+        """
+        Returns dictionary {neighbour: score} (built, not cached)
+        """
+
+        ids, scores = self.neighbours(word)
+
+        return dict(zip(map(self.attr.id2str, ids.tolist()), scores.tolist()))
+
+    def neighbours(self, word, pending=None):
+        """
+        Returns (ids, scores) arrays of neighbours of `word` sorted by ids
+
+        `pending` may map words to results of `_read_neighbours`
+        being prefetched (see `prefetch`)
+        """
 
         if word in self.cached_sims:
             return self.cached_sims[word]
 
+        # Records of the disk cache are (ids, scores) arrays
+        record = (
+            None if self.disk_cache is None
+            else self.disk_cache.get_record(word)
+        )
+
+        if record is not None:
+            ids, scores = record
+        elif pending is not None and word in pending:
+            ids, scores = pending.pop(word).get()
+        else:
+            ids, scores = self._read_neighbours(word)
+
+        if record is None and self.disk_cache is not None:
+            self.disk_cache.put_record(word, [ids, scores])
+
+        self.cached_sims[word] = ids, scores
+
+        return self.cached_sims[word]
+
+    def neighbours_many(self, words, pending=None):
+        """
+        Returns list of (ids, scores) of `neighbours` of each word
+        """
+        return [self.neighbours(word, pending) for word in words]
+
+    def _read_neighbours(self, word):
+        """
+        Reads (ids, scores) of `word` from the thesaurus, may run
+        in a thread of `prefetch` (so it touches no cache)
+        """
+
         word_i = self.attr.str2id(word)
 
         if word_i < 0:
             raise OutOfVocabError("Out-of-vocabulary word '%s'." % word)
 
-        thes = wmap.Thesaurus_f(self.wsthes, word_i)
+        thes = self.thesaurus(self.wsthes, word_i)
 
-        sims = dict()
+        ids, scores = [], []
 
         while not thes.eos():
-            sims[self.attr.id2str(thes.getid())] = thes.getscore()
+            ids.append(thes.getid())
+            scores.append(thes.getscore())
             thes.next()
 
-        self.cached_sims[word] = sims
+        ids = np.array(ids, dtype=np.int32)
+        scores = np.array(scores, dtype=np.float32)
+
+        order = np.argsort(ids, kind="mergesort")
+        return ids[order], scores[order]
+
+    def prefetch(self, words, pool, pending=None):
+        """
+        Starts reading neighbours of `words` (not cached yet) by threads
+        of `pool`, returns {word: async result} to be given to `neighbours`
+        (`pending` of words already being read is updated)
+        """
 
-        return sims
+        if pending is None:
+            pending = dict()
+
+        for word in words:
+            if word in pending or word in self.cached_sims:
+                continue
+            if self.disk_cache is not None and word in self.disk_cache:
+                continue
+            pending[word] = pool.apply_async(self._read_neighbours, (word, ))
+
+        return pending
 
     def most_similar(self, word, topn=10):
 
-        return sorted(self.similarities(word).items(), key=lambda (w, s): s,
-                      reverse=True)[:topn]
+        ids, scores = self.neighbours(word)
+        top = np.argsort(-scores, kind="mergesort")[:topn]
 
-    def solve_analogy(self, a, b, aa, mul=False):
+        return [(self.attr.id2str(i), s)
+                for i, s in zip(ids[top].tolist(), scores[top].tolist())]
 
-        sims_a, sims_b, sims_aa = (
-            defaultdict(lambda: 0.05, self.similarities(w))
-            for w in (a, b, aa)
+    def solve_analogy(self, a, b, aa, mul=False, pending=None):
+
+        (ids_a, sims_a), (ids_b, sims_b), (ids_aa, sims_aa) = (
+            self.neighbours_many((a, b, aa), pending)
         )
 
-        results = {
-            w: (sims_b[w] * sims_aa[w] / sims_a[w] if mul
-                else sims_b[w] + sims_aa[w] - sims_a[w])
-            for w in set(sims_b) & set(sims_aa) - {a}
-            }.items()
+        # Candidates are neighbours of both b and aa (except for a)
+        pos_b, pos_aa = _merge(ids_b, ids_aa)
+        cands = ids_b[pos_b]
 
-        return (
-            None if len(results) == 0
-            else max(results, key=lambda (c, s): s)[0]
-        )
+        keep = cands != self.attr.str2id(a)
+        cands, pos_b, pos_aa = cands[keep], pos_b[keep], pos_aa[keep]
+
+        if len(cands) == 0:
+            return None
+
+        # Similarities of the candidates to a (if they are its neighbours)
+        scores_a = np.full(len(cands), self.MISSING)
+        found, pos_a = _merge(cands, ids_a)
+        scores_a[found] = sims_a[pos_a]
 
-    def eval_on_dataset(self, dataset, mul=False):
+        # (in double precision, as the thesaurus scores are floats)
+        scores_b = sims_b[pos_b].astype(np.float64)
+        scores_aa = sims_aa[pos_aa].astype(np.float64)
+
+        if mul:
+            scores = scores_b * scores_aa / scores_a
+        else:
+            scores = scores_b + scores_aa - scores_a
+
+        return self.attr.id2str(int(cands[np.argmax(scores)]))
+
+    def eval_on_dataset(self, dataset, mul=False, prefetch=4, ahead=64):
+        """
+        While queries are scored, neighbours of the upcoming words are
+        read by `prefetch` threads (0 to read them lazily), at most
+        `ahead` words at a time
+        """
 
         results = {
             category_label: dict(acc=0.0, oov=0, queries=list())
@@ -106,24 +232,132 @@ class OriginalThesaurus(object):
             in dataset
         }
 
-        for cat, queries in dataset.items():
+        # Words of the queries in order
+        words = [w for queries in dataset.values()
+                 for a, b, aa, __ in queries for w in (a, b, aa)]
+        n = 0  # words before `n` are cached or being read
+
+        pool = ThreadPool(prefetch) if prefetch > 0 else None
+        pending = dict() if pool is not None else None
 
-            for a, b, aa, bbs in queries:
+        try:
+            for cat, queries in dataset.items():
 
-                try:
-                    candidate = self.solve_analogy(a, b, aa, mul)
-                except OutOfVocabError:
-                    results[cat]["oov"] += 1
-                    continue
+                for a, b, aa, bbs in queries:
 
-                if candidate in bbs:
-                    results[cat]["acc"] += 1
+                    if pool is not None:
+                        while n < len(words) and len(pending) < ahead:
+                            self.prefetch(words[n:n + 1], pool, pending)
+                            n += 1
 
-                results[cat]["queries"].append(
-                    (a, b, aa, candidate, candidate in bbs)
-                )
+                    try:
+                        candidate = self.solve_analogy(a, b, aa, mul,
+                                                       pending)
+                    except OutOfVocabError:
+                        results[cat]["oov"] += 1
+                        if pending is not None:  # left unused
+                            for word in (a, b, aa):
+                                pending.pop(word, None)
+                        continue
 
-            # After all queries are processed:
-            results[cat]["acc"] /= float(len(queries))
+                    if candidate in bbs:
+                        results[cat]["acc"] += 1
+
+                    results[cat]["queries"].append(
+                        (a, b, aa, candidate, candidate in bbs)
+                    )
+
+                # After all queries are processed:
+                results[cat]["acc"] /= float(len(queries))
+        finally:
+            if pool is not None:
+                pool.terminate()
 
         return results
+
+
+class NeighbourStore(object):
+    """
+    Dict-like cache {word: (ids, scores)} of neighbour lists
+
+    All lists are kept in one pair of growing int32/float32 arrays
+    (like a CSR matrix with rows in the order of insertion), so a
+    neighbour costs 8 bytes instead of ~200 of nested dictionaries.
+    Looked up lists are read-only views of these arrays.
+    """
+
+    def __init__(self, capacity=2**16):
+
+        self.ids = np.empty((capacity, ), dtype=np.int32)
+        self.scores = np.empty((capacity, ), dtype=np.float32)
+        self.size = 0
+
+        self.rows = dict()  # {word: (beg, end)}
+
+    def __contains__(self, word):
+        return word in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, word):
+
+        beg, end = self.rows[word]
+
+        ids, scores = self.ids[beg:end], self.scores[beg:end]
+        ids.flags.writeable = scores.flags.writeable = False
+
+        return ids, scores
+
+    def __setitem__(self, word, neighbours):
+
+        ids, scores = neighbours
+        beg, end = self.size, self.size + len(ids)
+
+        if end > len(self.ids):
+            capacity = max(end, 2 * len(self.ids))
+            self.ids = _resized(self.ids, capacity, self.size)
+            self.scores = _resized(self.scores, capacity, self.size)
+
+        self.ids[beg:end] = ids
+        self.scores[beg:end] = scores
+        self.size = end
+
+        # A replaced list stays in the arrays (unreachable)
+        self.rows[word] = beg, end
+
+    def nbytes(self):
+        return self.ids.nbytes + self.scores.nbytes
+
+
+def _resized(array, capacity, size):
+    new = np.empty((capacity, ), dtype=array.dtype)
+    new[:size] = array[:size]
+    return new
+
+
+def _merge(ids, other_ids):
+    """
+    For sorted arrays of unique ids, returns positions of their common
+    ids in `ids` and in `other_ids`
+
+    Each id of the shorter array is looked up in the longer one
+    (a merge in O(short * log(long)) steps).
+    """
+
+    if len(ids) > len(other_ids):
+        other_pos, pos = _merge(other_ids, ids)
+        return pos, other_pos
+
+    if len(other_ids) == 0:
+        empty = np.zeros((0, ), dtype=np.int64)
+        return empty, empty
+
+    pos = np.searchsorted(other_ids, ids)
+    pos[pos == len(other_ids)] = 0
+    found = np.flatnonzero(other_ids[pos] == ids)
+
+    return found, pos[found]
@@ -0,0 +1,141 @@
+"""
+Quantized Embeddings
+====================
+
+Dense embeddings (see `models.SkEThesSVD`, `models.Word2Vec`) stored
+as int8 values with a float32 scale per row: a quarter of float32.
+Rows are dequantized on the fly, block by block, in products:
+
+    [NAME]-quant-values.npy  # (vocab, dim) int8
+    [NAME]-quant-scales.npy  # (vocab, ) float32
+
+To see what the quantization costs on a dataset, compare accuracies
+of the same model in full and reduced precision:
+
+    from datasets import ccc_pairs
+    from deval import pairs2queries
+
+    full = SkEThesSVD("bnc2-svd300")
+    small = SkEThesSVD("bnc2-svd300", quantized=True)
+    report = accuracy_delta(full, small, {"ccc": pairs2queries(ccc_pairs)})
+"""
+
+import os
+import numpy as np
+
+# Local imports
+from deval import BLOCK_SIZE
+
+
+class QuantizedMatrix(object):
+    """
+    Read-only dense matrix of int8 values scaled by rows, supports
+    `m[ids]` (dequantized rows) and `m.dot(x)` like a numpy array
+    """
+
+    def __init__(self, values, scales):
+        self.values = values
+        self.scales = scales
+        self.shape = values.shape
+
+    @classmethod
+    def quantize(cls, matrix, block_size=16 * BLOCK_SIZE):
+        """
+        Each row is scaled so that its largest absolute value is 127
+        """
+
+        values = np.zeros(matrix.shape, dtype=np.int8)
+        scales = np.zeros((matrix.shape[0], ), dtype=np.float32)
+
+        for beg in range(0, matrix.shape[0], block_size):
+            block = np.asarray(matrix[beg:beg + block_size], dtype=np.float32)
+            block_scales = np.abs(block).max(axis=1) / 127
+            block_scales[block_scales == 0] = 1
+
+            values[beg:beg + block_size] = np.rint(
+                block / block_scales[:, np.newaxis])
+            scales[beg:beg + block_size] = block_scales
+
+        return cls(values, scales)
+
+    @classmethod
+    def load(cls, name, mmap_mode="r"):
+        return cls(
+            np.load(name + "-quant-values.npy", mmap_mode=mmap_mode),
+            np.load(name + "-quant-scales.npy", mmap_mode=mmap_mode)
+        )
+
+    @classmethod
+    def exists(cls, name, source=None):
+        """
+        If `source` is given, the files must not be older than it
+        (i.e. quantized from its current content)
+        """
+
+        paths = [name + "-quant-%s.npy" % array
+                 for array in ("values", "scales")]
+
+        if not all(os.path.exists(path) for path in paths):
+            return False
+
+        return source is None or all(
+            os.path.getmtime(path) >= os.path.getmtime(source)
+            for path in paths
+        )
+
+    def save(self, name):
+        np.save(name + "-quant-values.npy", self.values)
+        np.save(name + "-quant-scales.npy", self.scales)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, ids):
+        values = self.values[ids].astype(np.float32)
+        scales = self.scales[ids]
+        return values * (scales[..., np.newaxis] if values.ndim > 1
+                         else scales)
+
+    def dot(self, x, block_size=16 * BLOCK_SIZE):
+        """
+        Returns the product of the matrix by a vector or a matrix `x`
+        """
+
+        x = np.asarray(x, dtype=np.float32)
+        out = np.zeros((self.shape[0], ) + x.shape[1:], dtype=np.float32)
+
+        for beg in range(0, self.shape[0], block_size):
+            end = beg + block_size
+            product = self.values[beg:end].astype(np.float32).dot(x)
+            scales = self.scales[beg:end]
+            out[beg:end] = product * (scales[:, np.newaxis] if x.ndim > 1
+                                      else scales)
+
+        return out
+
+
+def accuracy_delta(full_model, model, dataset, **kwargs):
+    """
+    Evaluates both models on `dataset` (with `eval_analogy` `kwargs`)
+    and returns {category: (full accuracy, accuracy, delta)} including
+    the "all" category (averaged over queries)
+    """
+
+    full = full_model.eval_analogy(dataset, **kwargs)
+    reduced = model.eval_analogy(dataset, **kwargs)
+
+    report = {
+        cat: (full[cat]["acc"], reduced[cat]["acc"],
+              reduced[cat]["acc"] - full[cat]["acc"])
+        for cat in dataset
+    }
+
+    nb_queries = float(max(1, sum(map(len, dataset.values()))))
+    full_acc, acc = (
+        sum(results[cat]["acc"] * len(dataset[cat]) for cat in dataset)
+        / nb_queries
+        for results in (full, reduced)
+    )
+    report["all"] = (full_acc, acc, acc - full_acc)
+
+    return report
@@ -0,0 +1,142 @@
+"""
+Evaluation Runner
+=================
+
+Evaluates several models on several datasets with several settings
+of `eval_analogy` and saves every result as a report (see `misc.py`):
+
+    from functools import partial
+    from formulas import add, mul
+    from models import SkEThesCOS
+    from runner import run
+    from weightings import ppmi
+
+    run(
+        models={"cos": partial(SkEThesCOS, "bnc2-matrix", weighting=ppmi)},
+        datasets={"bats": bats_dataset},
+        configs=[dict(formula=add, topn=1), dict(formula=mul, topn=10)],
+        workers=8,
+    )
+
+Each model is loaded only once.  Its categories are then evaluated
+by a pool of processes forked after the loading, so they share the
+model (memory-mapped matrices are shared even across runs).  Each
+process solves a category with all the pending settings at once,
+hence similarities of its words are computed only once.
+
+Reports which already exist are skipped, so an interrupted run may
+be simply restarted.
+"""
+
+import os
+
+from functools import partial
+
+# Local imports
+from formulas import add as default_formula
+from misc import imap_forked, report_path, save_report
+
+
+def config_name(config):
+    """
+    Name of `eval_analogy` settings, e.g. "mul-topn=10"
+
+    `batch_size` does not change the results, so it is not included.
+    """
+
+    formula = config.get("formula", default_formula)
+    if isinstance(formula, partial):
+        keywords = sorted((formula.keywords or {}).items())
+        formula_name = "%s(%s)" % (formula.func.__name__, ",".join(
+            [repr(arg) for arg in formula.args] +
+            ["%s=%r" % keyword for keyword in keywords]
+        ))
+    else:
+        formula_name = formula.__name__
+
+    return "-".join([formula_name] + [
+        "%s=%s" % (key, value) for key, value in sorted(config.items())
+        if key not in ("formula", "batch_size")
+    ])
+
+
+def run(models, datasets, configs, directory="reports/", workers=1):
+    """
+    `models` is a dictionary {model_name: function loading the model},
+    `datasets` is a dictionary {dataset_name: {category: queries}},
+    `configs` is a list of dictionaries of `eval_analogy` arguments
+
+    Returns paths of the reports saved by this run.
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    saved = []
+
+    for model_name, load_model in sorted(models.items()):
+
+        # Reports (dataset_name, config index) to be done
+        pending = {
+            (dataset_name, k): report_path(
+                dataset_name, model_name, config_name(config), directory)
+            for dataset_name in datasets
+            for k, config in enumerate(configs)
+        }
+        pending = {
+            report: path for report, path in pending.items()
+            if not os.path.exists(path)
+        }
+        if len(pending) == 0:
+            continue
+
+        # A job is a category of a dataset with all its pending configs,
+        # the largest categories go first
+        jobs = [
+            (dataset_name, cat, sorted(
+                k for name, k in pending if name == dataset_name))
+            for dataset_name in sorted({name for name, __ in pending})
+            for cat in datasets[dataset_name]
+        ]
+        jobs.sort(key=lambda job: -len(datasets[job[0]][job[1]]))
+
+        reports = {report: dict() for report in pending}
+
+        results = imap_forked(
+            _eval_worker, jobs, workers,
+            model=load_model(), datasets=datasets, configs=configs
+        )
+
+        for dataset_name, cat, config_ids, cat_results in results:
+            for k, result in zip(config_ids, cat_results):
+                report = reports[dataset_name, k]
+                report[cat] = result
+
+                # Saved as soon as all its categories are done
+                if len(report) == len(datasets[dataset_name]):
+                    save_report(report, dataset_name, model_name,
+                                config_name(configs[k]), directory)
+                    saved.append(pending[dataset_name, k])
+
+    return saved
+
+
+def _eval_worker(job, state):
+
+    dataset_name, cat, config_ids = job
+
+    model = state["model"]
+    queries = state["datasets"][dataset_name][cat]
+    configs = state["configs"]
+
+    results = [
+        model.eval_analogy({cat: queries}, **configs[k])[cat]
+        for k in config_ids
+    ]
+
+    # Similarities of this category are not needed any more
+    # (unless they are kept in a cache of the user's choice)
+    if type(model.cached_sims) is dict:
+        model.cached_sims.clear()
+
+    return dataset_name, cat, config_ids, results
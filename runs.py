@@ -0,0 +1,177 @@
+"""
+Sorted Runs
+===========
+
+External-memory summing of (key, value) pairs.
+
+Pairs are buffered in memory, and whenever the buffer exceeds its
+budget, it is sorted, the values of equal keys are summed, and the
+result (a sorted run) is spilled to disk.  At the end, all runs are
+k-way merged in chunks, so the memory stays bounded by the budget.
+
+Matrix cells are encoded as 64bit keys `row << 32 | col`, hence sorted
+keys are in the row-major (CSR-ready) order.
+"""
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from numpy.lib.format import open_memmap
+
+
+MEMORY = 10**9  # default budget in bytes
+
+# Sorting a buffer needs a few copies of it, so each buffered
+# (key, value) pair of 16 bytes is accounted as ITEM_BYTES
+ITEM_BYTES = 64
+
+
+def encode(rows, cols):
+    return (np.asarray(rows, dtype=np.int64) << 32) | cols
+
+
+def decode(keys):
+    return (keys >> 32).astype(np.int32), (keys & 0xffffffff).astype(np.int32)
+
+
+def sum_duplicates(keys, vals):
+    """
+    Sorts the pairs by keys and sums values of equal keys
+    """
+
+    order = np.argsort(keys, kind="mergesort")
+    keys, vals = keys[order], vals[order]
+
+    if len(keys) == 0:
+        return keys, vals
+
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    return keys[starts], np.add.reduceat(vals, starts)
+
+
+class SortedRuns(object):
+
+    def __init__(self, memory=MEMORY, directory=None, val_dtype=np.int64):
+        """
+        `memory` is the budget in bytes,
+        runs are spilled to a temporary subdirectory of `directory`
+        """
+
+        self.max_items = max(1, memory // ITEM_BYTES)
+        self.val_dtype = val_dtype
+        self.directory = tempfile.mkdtemp(prefix="runs-", dir=directory)
+
+        self.keys = []
+        self.vals = []
+        self.nb_buffered = 0
+        self.runs = []  # paths of spilled runs
+
+    def add(self, keys, vals):
+
+        self.keys.append(np.asarray(keys, dtype=np.int64))
+        self.vals.append(np.asarray(vals, dtype=self.val_dtype))
+        self.nb_buffered += len(keys)
+
+        if self.nb_buffered >= self.max_items:
+            self.spill()
+
+    def extend(self, run_paths):
+        """
+        Adds runs spilled by another `SortedRuns` (e.g. of a worker process)
+        """
+        self.runs.extend(run_paths)
+
+    def spill(self):
+
+        if self.nb_buffered == 0:
+            return
+
+        keys, vals = sum_duplicates(
+            np.concatenate(self.keys), np.concatenate(self.vals)
+        )
+        self.keys, self.vals, self.nb_buffered = [], [], 0
+
+        path = os.path.join(self.directory, "run%i" % len(self.runs))
+        np.save(path + "-keys.npy", keys)
+        np.save(path + "-vals.npy", vals)
+        self.runs.append(path)
+
+    def merge(self):
+        """
+        Yields (keys, vals) chunks of all the pairs added so far,
+        sorted by keys and with values of equal keys summed
+        """
+
+        self.spill()
+
+        runs = [
+            (np.load(path + "-keys.npy", mmap_mode="r"),
+             np.load(path + "-vals.npy", mmap_mode="r"))
+            for path in self.runs
+        ]
+        positions = [0] * len(runs)
+        step = max(1, self.max_items // max(1, len(runs)))
+
+        while True:
+
+            # Every key up to the smallest of the chunk ends can be
+            # finalized.  The run owning it advances by a whole chunk.
+            ends = [
+                keys[min(pos + step, len(keys)) - 1]
+                for (keys, __), pos in zip(runs, positions)
+                if pos < len(keys)
+            ]
+            if len(ends) == 0:
+                break
+            bound = min(ends)
+
+            chunk_keys, chunk_vals = [], []
+            for r, (keys, vals) in enumerate(runs):
+                beg = positions[r]
+                end = beg + np.searchsorted(
+                    keys[beg:beg + step], bound, side="right")
+                chunk_keys.append(keys[beg:end])
+                chunk_vals.append(vals[beg:end])
+                positions[r] = end
+
+            yield sum_duplicates(
+                np.concatenate(chunk_keys), np.concatenate(chunk_vals)
+            )
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ArrayWriter(object):
+    """
+    Writes a .npy array whose length is not known in advance
+    """
+
+    def __init__(self, path, dtype, directory=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        fd, self.raw_path = tempfile.mkstemp(suffix=".raw", dir=directory)
+        self.raw = os.fdopen(fd, "wb")
+
+    def append(self, arr):
+        np.asarray(arr, dtype=self.dtype).tofile(self.raw)
+        self.size += len(arr)
+
+    def close(self, block_size=10**7):
+
+        self.raw.close()
+
+        out = open_memmap(self.path, mode="w+", dtype=self.dtype,
+                          shape=(self.size, ))
+        if self.size > 0:
+            raw = np.memmap(self.raw_path, dtype=self.dtype, mode="r")
+            for beg in range(0, self.size, block_size):
+                out[beg:beg + block_size] = raw[beg:beg + block_size]
+            del raw
+        out.flush()
+        del out
+
+        os.remove(self.raw_path)
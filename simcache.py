@@ -0,0 +1,284 @@
+"""
+Similarity Caches
+=================
+
+Caches for vectors of similarities of words to the whole vocabulary
+(see `DiMo.cached_sims`).  By default, a model caches them in a plain
+dictionary, which only grows.  Use `SimilarityCache` to bound it:
+
+    model.use_cache(SimilarityCache(max_bytes=4 * 10**9, dtype=np.float32))
+
+`DiskCache` keeps the vectors in files instead, so they survive the
+session and are shared by all processes using the same directory:
+
+    model.use_disk_cache("simcache/")
+"""
+
+import binascii
+import fcntl
+import os
+import numpy as np
+
+from collections import OrderedDict
+
+# Local imports
+from misc import digest
+from vocab import _encode
+
+
+class SimilarityCache(object):
+    """
+    Dict-like cache {word: vector} with a memory budget
+
+    When adding a vector would exceed `max_bytes`, the least recently
+    used vectors are evicted.  If `dtype` is given, vectors are stored
+    converted to it (e.g. float32 halves the memory of float64).
+    Vectors stored as float16 are read as float32.
+    """
+
+    def __init__(self, max_bytes=None, dtype=None):
+
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+
+        self.vectors = OrderedDict()  # from the least recently used
+        self.nb_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, word):
+        return word in self.vectors
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __iter__(self):
+        return iter(self.vectors)
+
+    def __getitem__(self, word):
+
+        try:
+            vector = self.vectors.pop(word)
+        except KeyError:
+            self.misses += 1
+            raise
+
+        self.vectors[word] = vector  # the most recently used now
+        self.hits += 1
+
+        return _dequantized(vector)
+
+    def get(self, word, default=None):
+        try:
+            return self[word]
+        except KeyError:
+            return default
+
+    def stored(self, vector):
+        """ Returns `vector` as it is read from the cache. """
+        return _dequantized(np.asarray(vector, dtype=self.dtype))
+
+    def __setitem__(self, word, vector):
+
+        vector = np.asarray(vector, dtype=self.dtype)
+
+        if word in self.vectors:
+            self.nb_bytes -= self.vectors.pop(word).nbytes
+
+        if self.max_bytes is not None:
+            if vector.nbytes > self.max_bytes:
+                return  # would not fit even alone
+
+            while self.nb_bytes + vector.nbytes > self.max_bytes:
+                __, evicted = self.vectors.popitem(last=False)
+                self.nb_bytes -= evicted.nbytes
+                self.evictions += 1
+
+        self.vectors[word] = vector
+        self.nb_bytes += vector.nbytes
+
+    def clear(self):
+        self.vectors.clear()
+        self.nb_bytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, size=len(self.vectors),
+                    nb_bytes=self.nb_bytes)
+
+
+class DiskCache(object):
+    """
+    Dict-like persistent cache {word: vector} of one model
+
+    Records are stored in a subdirectory of `directory` named by
+    the digest of `key`, which identifies the model:
+
+        data    # concatenated arrays, memory-mapped for reading
+        index   # lines "hex(word) TAB offset TAB dtype:len,..."
+        lock    # serializes writers
+        key     # repr(key), for humans
+
+    Both files are append-only and a record is indexed only after its
+    data are written, so processes may read the cache while others
+    populate it (new records are picked up on a miss).
+
+    Vectors are stored converted to `dtype` (float16 ones are read
+    as float32).  A record may also consist
+    of several 1d arrays of any dtypes (see `get_record`, `put_record`).
+    """
+
+    ALIGNMENT = 16
+
+    def __init__(self, directory, key, dtype=np.float32):
+
+        self.directory = os.path.join(directory, digest(key))
+        self.dtype = dtype
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):  # not a race
+                    raise
+
+        self.data_path = os.path.join(self.directory, "data")
+        self.index_path = os.path.join(self.directory, "index")
+        self.lock_path = os.path.join(self.directory, "lock")
+
+        with self._locked():
+            for path in (self.data_path, self.index_path):
+                open(path, "ab").close()
+            with open(os.path.join(self.directory, "key"), "w") as f:
+                f.write(repr(key) + "\n")
+
+        self.index = dict()  # {encoded word: (offset, [(dtype, len)])}
+        self.index_pos = 0  # already read part of the index file
+        self.data = None  # memory map of the data file
+
+        self.refresh()
+
+    def _locked(self):
+        return _FileLock(self.lock_path)
+
+    def refresh(self):
+        """
+        Reads records indexed (by any process) since the last refresh
+        """
+
+        with open(self.index_path, "rb") as f:
+            f.seek(self.index_pos)
+            new = f.read()
+
+        # An incomplete last line is being written right now
+        complete = new[:new.rfind(b"\n") + 1]
+        self.index_pos += len(complete)
+
+        for line in complete.splitlines():
+            word, offset, arrays = line.split(b"\t")
+            self.index[binascii.unhexlify(word)] = (int(offset), [
+                (np.dtype(dtype), int(length)) for dtype, length in
+                (array.split(b":") for array in arrays.split(b","))
+            ])
+
+    def get_record(self, word, default=None):
+        """
+        Returns the list of arrays stored for `word` (read-only)
+        """
+
+        raw = _encode(word)
+        if raw not in self.index:
+            self.refresh()
+            if raw not in self.index:
+                return default
+
+        offset, arrays = self.index[raw]
+        end = offset + sum(dtype.itemsize * length for dtype, length in arrays)
+
+        if self.data is None or len(self.data) < end:
+            self.data = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+
+        record = []
+        for dtype, length in arrays:
+            beg, offset = offset, offset + dtype.itemsize * length
+            record.append(self.data[beg:offset].view(dtype))
+
+        return record
+
+    def put_record(self, word, arrays):
+        """
+        Stores arrays for `word` unless some process already did
+        """
+
+        raw = _encode(word)
+        arrays = [np.ascontiguousarray(array).ravel() for array in arrays]
+
+        with self._locked():
+            self.refresh()
+            if raw in self.index:
+                return
+
+            with open(self.data_path, "ab") as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                offset = size + -size % self.ALIGNMENT
+                f.write(b"\0" * (offset - size))
+                for array in arrays:
+                    f.write(array.tostring())
+
+            line = b"%s\t%i\t%s\n" % (binascii.hexlify(raw), offset, b",".join(
+                b"%s:%i" % (array.dtype.str, len(array)) for array in arrays
+            ))
+            with open(self.index_path, "ab") as f:
+                f.write(line)
+
+    def __contains__(self, word):
+        return self.get_record(word) is not None
+
+    def __getitem__(self, word):
+        record = self.get_record(word)
+        if record is None:
+            raise KeyError(word)
+        return _dequantized(record[0])
+
+    def get(self, word, default=None):
+        record = self.get_record(word)
+        return default if record is None else _dequantized(record[0])
+
+    def stored(self, vector):
+        """ Returns `vector` as it is read from the cache. """
+        return _dequantized(np.asarray(vector, dtype=self.dtype))
+
+    def __setitem__(self, word, vector):
+        self.put_record(word, [np.asarray(vector, dtype=self.dtype)])
+
+    def __len__(self):
+        self.refresh()
+        return len(self.index)
+
+    def __iter__(self):
+        self.refresh()
+        return iter(list(self.index))
+
+
+class _FileLock(object):
+    """
+    Exclusive lock of a file (as a context manager)
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.f = open(self.path, "a")
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def _dequantized(vector):
+    return vector.astype(np.float32) if vector.dtype == np.float16 else vector
@@ -0,0 +1,270 @@
+"""
+Low-Rank (SVD) Embeddings
+=========================
+
+Compresses a (weighted) target-context matrix of a `SkEThes` model
+into dense vectors by a truncated randomized SVD:
+
+    M ~ U * diag(S) * V^T,  embedding = normalized rows of U * S**power
+
+The embedding and the vocabulary of the model are saved as
+
+    [NAME]-svd-embedding.npy  # (vocab, dim) float32 unit vectors
+    [NAME]-svd-singular.npy   # (dim, ) singular values
+    [NAME]-quant-*.npy        # the embedding in int8 (see `quant.py`)
+    [NAME]-vocab-*.npy
+
+and opened as an ordinary model (see `models.SkEThesSVD`):
+
+    from models import SkEThesCOS, SkEThesSVD
+    from svd import build_svd
+
+    build_svd(SkEThesCOS("bnc2-matrix", weighting=ppmi), "bnc2-svd300")
+    model = SkEThesSVD("bnc2-svd300")
+
+`power` weights the singular values: 1 gives the best approximation
+of M, 0.5 or 0 (just U) often work better for similarities.
+
+Matrices too large for memory are factorized by `build_svd_out_of_core`
+straight from their files (memory-mapped), block by block of rows.
+"""
+
+import numpy as np
+
+from multiprocessing.pool import ThreadPool
+from scipy.sparse import csr_matrix
+from sklearn.preprocessing import normalize
+from sklearn.utils.extmath import randomized_svd
+
+# Local imports
+import csrformat
+import vocab
+from quant import QuantizedMatrix
+from weightings import NEEDS_MARGINALS, row_blocks
+
+
+CHUNK_SIZE = 10**7  # max. nb of values of a block of rows
+
+
+def build_svd(model, name, dim=300, power=0.5, n_iter=5, seed=0):
+    """
+    Factorizes `model.M` into `dim` dimensions and saves the embedding
+    """
+
+    U, S, __ = randomized_svd(model.M, dim, n_iter=n_iter,
+                              random_state=seed)
+
+    save_embedding(name, U, S, power, model.vocab)
+
+
+def save_embedding(name, U, S, power, vocabulary):
+
+    embedding = np.asarray(U * S ** power, dtype=np.float32)
+    normalize(embedding, copy=False)
+
+    np.save(name + "-svd-embedding.npy", embedding)
+    np.save(name + "-svd-singular.npy", S)
+    QuantizedMatrix.quantize(embedding).save(name)
+    vocabulary.save(name)
+
+
+def build_svd_out_of_core(name, output_name, dim=300, power=0.5,
+                          weighting=None, n_iter=2, oversample=10,
+                          chunk_size=CHUNK_SIZE, workers=4, seed=0,
+                          dtype=np.float64):
+    """
+    Factorizes matrix [NAME] (see `MatrixBlocks`) without loading it
+    and saves the embedding as `build_svd` does
+
+    A randomized range finder (with `n_iter` power iterations) needs
+    only products of the matrix and its transpose by dense (*, dim +
+    `oversample`) matrices.  These are computed block by block of rows
+    (read from the disk, weighted, multiplied), `workers` blocks at
+    once in threads.  Besides the blocks, the memory holds just a few
+    such dense matrices.
+
+    Blocks and products are computed in `dtype`; np.float32 halves
+    their memory (the factorization loses little precision).
+    """
+
+    blocks = MatrixBlocks(name, chunk_size, dtype)
+
+    marginals = None
+    if getattr(weighting, "func", weighting) in NEEDS_MARGINALS:
+        marginals = blocks.marginals()
+
+    product = _BlockProducts(blocks, weighting, marginals, workers)
+    rs = np.random.RandomState(seed)
+    k = min(dim + oversample, min(blocks.shape))
+
+    # Range of M: Q with orthonormal cols such that M ~ Q Q^T M
+    Q = product.dot(rs.normal(size=(blocks.shape[1], k)))
+    Q = np.linalg.qr(Q)[0]
+    for __ in range(n_iter):
+        Q = np.linalg.qr(product.tdot(Q))[0]
+        Q = np.linalg.qr(product.dot(Q))[0]
+
+    # SVD of the small B = Q^T M gives the SVD of M
+    Ub, S, __ = np.linalg.svd(product.tdot(Q).T, full_matrices=False)
+    U = Q.dot(Ub[:, :dim])
+    product.close()
+
+    save_embedding(output_name, U, S[:dim], power, blocks.vocab)
+
+
+class MatrixBlocks(object):
+    """
+    Blocks of rows of a target-context matrix stored either in the
+    native CSR format (see `csrformat.py`) or in [NAME]-{rows,cols,vals}
+    files sorted by rows (as `coocs.py` writes them)
+
+    Values of blocks are converted to `dtype`.  If the matrix is stored
+    as its upper triangle (see `csrformat.py`), blocks are just rows
+    of the triangle (`upper` is True).
+    """
+
+    def __init__(self, name, chunk_size=CHUNK_SIZE, dtype=np.float64):
+
+        self.dtype = np.dtype(dtype)
+        self.upper = csrformat.is_upper(name)
+
+        if csrformat.exists(name):
+            m, self.vocab = csrformat.load_csr(name)
+            self.indptr, self.cols, self.vals = m.indptr, m.indices, m.data
+            self.shape = m.shape
+        else:
+            self.vocab = vocab.load(name)
+            rows = np.load(name + "-rows.npy", mmap_mode="r")
+            self.cols = np.load(name + "-cols.npy", mmap_mode="r")
+            self.vals = np.load(name + "-vals.npy", mmap_mode="r")
+
+            nb_rows, nb_cols = len(self.vocab), 0
+            for beg in range(0, len(rows), chunk_size):
+                chunk = np.asarray(rows[max(0, beg - 1):beg + chunk_size])
+                if np.any(chunk[1:] < chunk[:-1]):
+                    raise ValueError("Rows of %s are not sorted, convert "
+                                     "it by `csrformat.py`." % name)
+                nb_rows = max(nb_rows, chunk[-1] + 1)
+                nb_cols = max(nb_cols, self.cols[beg:beg + chunk_size].max()
+                              + 1)
+
+            if self.upper:
+                nb_rows = nb_cols = max(nb_rows, nb_cols)
+            self.indptr = np.searchsorted(rows, np.arange(nb_rows + 1))
+            self.shape = (int(nb_rows), int(nb_cols))
+
+        # [beg, end) ranges of rows with at most `chunk_size` values
+        # (the blocks have `indptr` and `shape` of a csr_matrix)
+        self.ranges = row_blocks(self, chunk_size)
+
+    def block(self, beg, end):
+        """
+        Returns rows [beg, end) as a csr_matrix with its own values
+        """
+
+        lo, hi = self.indptr[beg], self.indptr[end]
+
+        m = csr_matrix(
+            (np.array(self.vals[lo:hi], dtype=self.dtype),
+             np.asarray(self.cols[lo:hi]),
+             np.asarray(self.indptr[beg:end + 1]) - lo),
+            shape=(end - beg, self.shape[1])
+        )
+        m.sum_duplicates()  # (cells of COO files may repeat)
+
+        return m
+
+    def marginals(self):
+        """
+        Returns (row sums, col sums, sum of all values)
+        of the whole matrix
+        """
+
+        row_sums = np.zeros((self.shape[0], ))
+        col_sums = np.zeros((self.shape[1], ))
+        diagonal = np.zeros((self.shape[0], ))
+
+        for beg, end in self.ranges:
+            m = self.block(beg, end)
+            row_sums[beg:end] = np.array(m.sum(axis=1, dtype=np.float64))[:, 0]
+            col_sums += np.array(m.sum(axis=0, dtype=np.float64))[0, :]
+            if self.upper:
+                diagonal[beg:end] = m.diagonal(k=beg)
+
+        if self.upper:
+            row_sums = col_sums = row_sums + col_sums - diagonal
+
+        return row_sums, col_sums, row_sums.sum()
+
+
+class _BlockProducts(object):
+    """
+    Products of a weighted `MatrixBlocks` matrix by dense matrices
+    """
+
+    def __init__(self, blocks, weighting, marginals, workers):
+        self.blocks = blocks
+        self.weighting = weighting
+        self.marginals = marginals
+        self.workers = workers
+        self.pool = ThreadPool(workers)
+
+    def _block(self, beg, end):
+
+        m = self.blocks.block(beg, end)
+
+        if self.marginals is not None:
+            row_sums, col_sums, all_sum = self.marginals
+            self.weighting(m, marginals=(row_sums[beg:end], col_sums, all_sum))
+        elif self.weighting is not None:
+            self.weighting(m)
+
+        if self.blocks.upper:
+            # M = U + U^T for the triangle U with a halved diagonal
+            rows = np.repeat(np.arange(beg, end), np.diff(m.indptr))
+            m.data[m.indices == rows] /= 2
+
+        return m
+
+    def dot(self, X):
+        """
+        Returns M X
+        """
+        return self._products(X, True, self.blocks.upper)
+
+    def tdot(self, X):
+        """
+        Returns M^T X
+        """
+        return self._products(X, self.blocks.upper, True)
+
+    def _products(self, X, direct, transposed):
+        """
+        Returns the sum of B X (if `direct`) and B^T X (if `transposed`)
+        over all blocks B
+        """
+
+        X = np.asarray(X, dtype=self.blocks.dtype)
+        out = np.zeros((self.blocks.shape[0 if direct else 1], X.shape[1]),
+                       dtype=X.dtype)
+
+        def multiply((beg, end)):
+            m = self._block(beg, end)
+            if direct:
+                out[beg:end] += m.dot(X)
+            if transposed:
+                return m.T.dot(X[beg:end])
+
+        # A wave of `workers` partial products at once
+        ranges = self.blocks.ranges
+        for k in range(0, len(ranges), self.workers):
+            for partial in self.pool.map(multiply,
+                                         ranges[k:k + self.workers]):
+                if partial is not None:
+                    out += partial
+
+        return out
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
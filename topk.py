@@ -0,0 +1,99 @@
+"""
+Top-K Similarity Index
+======================
+
+A precomputed thesaurus: for every target of a model, its K most
+similar words (the target itself included) and their similarities.
+
+    [NAME]-topk-ids.npy     # (vocab, K) int32 neighbour indices
+    [NAME]-topk-scores.npy  # (vocab, K) float32 similarities
+
+Rows are sorted by decreasing similarity.  Build the index once:
+
+    from topk import build_topk, TopKIndex
+
+    build_topk(model, "bnc2-matrix", k=100, workers=8)
+
+and let the model serve `most_similar` and `similarity` from it:
+
+    model.use_topk(TopKIndex("bnc2-matrix"))
+"""
+
+import numpy as np
+
+from numpy.lib.format import open_memmap
+
+# Local imports
+from deval import BLOCK_SIZE, top_indices
+from misc import imap_forked
+
+
+def top_k(scores, k):
+    """
+    Returns (ids, scores) of the `k` highest scores in each row of
+    the 2d array `scores`, sorted by decreasing scores
+    """
+
+    ids = top_indices(scores, k)
+    return ids, np.take_along_axis(scores, ids, axis=1)
+
+
+def build_topk(model, name, k=100, block_size=BLOCK_SIZE, workers=1):
+    """
+    Computes top `k` neighbours of all the targets of `model`
+    in blocks of `block_size` rows (see `DiMo.similarities_many`)
+
+    With `workers` > 1, blocks are processed by a pool of forked
+    processes, which share the already loaded `model`.
+    """
+
+    nb_rows = len(model.word2i)
+    k = min(k, nb_rows)
+
+    ids = open_memmap(name + "-topk-ids.npy", mode="w+", dtype=np.int32,
+                      shape=(nb_rows, k))
+    scores = open_memmap(name + "-topk-scores.npy", mode="w+",
+                         dtype=np.float32, shape=(nb_rows, k))
+
+    blocks = [
+        (beg, min(beg + block_size, nb_rows))
+        for beg in range(0, nb_rows, block_size)
+    ]
+
+    for beg, block_ids, block_scores in imap_forked(
+            _topk_worker, blocks, workers, model=model, k=k):
+        ids[beg:beg + len(block_ids)] = block_ids
+        scores[beg:beg + len(block_ids)] = block_scores
+
+    ids.flush()
+    scores.flush()
+
+
+def _topk_worker(block, state):
+    beg, end = block
+    sims = state["model"].similarities_many(list(range(beg, end)))
+    ids, scores = top_k(sims, state["k"])
+    return beg, ids, scores
+
+
+class TopKIndex(object):
+
+    def __init__(self, name, mmap_mode="r"):
+        self.ids = np.load(name + "-topk-ids.npy", mmap_mode=mmap_mode)
+        self.scores = np.load(name + "-topk-scores.npy", mmap_mode=mmap_mode)
+        self.k = self.ids.shape[1]
+
+    def neighbours(self, i, topn=None):
+        """
+        Returns (ids, scores) of the `topn` nearest neighbours of target `i`
+        """
+        topn = self.k if topn is None else topn
+        return self.ids[i, :topn], self.scores[i, :topn]
+
+    def similarity(self, i, j):
+        """
+        Returns similarity of targets `i` and `j`,
+        or None if `j` is not among the neighbours of `i`
+        """
+        found = np.flatnonzero(self.ids[i] == j)
+        return self.scores[i, found[0]] if len(found) > 0 else None
@@ -0,0 +1,230 @@
+"""
+Vocabulary Store
+================
+
+Maps words to indices and back without Python dictionaries.
+
+All words are kept UTF-8 encoded in a single byte buffer, the i-th one
+being `buf[offsets[i]:offsets[i + 1]]`.  Looking up an index of a word
+is a binary search in the indices sorted by their words (`order`).
+
+A vocabulary is stored in three files, which may be memory-mapped:
+
+    [NAME]-vocab-buf.npy      # concatenated words
+    [NAME]-vocab-offsets.npy  # word boundaries
+    [NAME]-vocab-order.npy    # indices sorted by words
+"""
+
+import os
+import pickle
+import numpy as np
+
+
+ARRAYS = ("buf", "offsets", "order")
+
+
+def exists(name):
+    return all(
+        os.path.exists(name + "-vocab-" + array + ".npy") for array in ARRAYS
+    )
+
+
+def load(name, mmap_mode="r"):
+    """
+    Loads the vocabulary of [NAME] from its files, or else converts
+    [NAME]-target2i.pickle (as the original `coocs.py` writes it)
+    """
+
+    if exists(name):
+        return Vocabulary.load(name, mmap_mode=mmap_mode)
+
+    with open(name + "-target2i.pickle") as f:
+        return Vocabulary.from_word2i(pickle.load(f))
+
+
+def _encode(word):
+    return word.encode("utf-8") if type(word) is unicode else word
+
+
+class Vocabulary(object):
+
+    def __init__(self, buf, offsets, order, unicode_words=False):
+        """
+        Use `from_words` or `load` rather than this
+
+        If `unicode_words` is True, words are returned as unicode strings,
+        otherwise as (UTF-8 encoded) byte strings
+        """
+
+        self.buf = buf
+        self.offsets = offsets
+        self.order = order
+        self.unicode_words = unicode_words
+        self._view = None  # `buf` as a buffer object (for lookups)
+
+        # dict-like views
+        self.word2i = _Word2I(self)
+        self.i2word = _I2Word(self)
+
+    @classmethod
+    def from_words(cls, words, unicode_words=False):
+        """
+        `words` is a sequence of unique words, the i-th one gets index i
+        """
+
+        encoded = [_encode(word) for word in words]
+
+        offsets = np.zeros((len(encoded) + 1, ), dtype=np.int64)
+        offsets[1:] = np.cumsum([len(word) for word in encoded])
+
+        buf = np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()
+
+        order = np.array(
+            sorted(range(len(encoded)), key=encoded.__getitem__),
+            dtype=np.int32 if len(encoded) < 2**31 else np.int64
+        )
+
+        return cls(buf, offsets, order, unicode_words)
+
+    @classmethod
+    def from_word2i(cls, word2i, unicode_words=False):
+
+        words = [None] * len(word2i)
+        for word, i in word2i.items():
+            words[i] = word
+
+        return cls.from_words(words, unicode_words)
+
+    @classmethod
+    def load(cls, name, mmap_mode="r", unicode_words=False):
+
+        buf, offsets, order = (
+            np.load(name + "-vocab-" + array + ".npy", mmap_mode=mmap_mode)
+            for array in ARRAYS
+        )
+
+        return cls(buf, offsets, order, unicode_words)
+
+    def save(self, name):
+        for array in ARRAYS:
+            np.save(name + "-vocab-" + array + ".npy", getattr(self, array))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def word(self, i):
+
+        raw = self._buffer()[self.offsets.item(i):self.offsets.item(i + 1)]
+
+        return raw.decode("utf-8") if self.unicode_words else raw
+
+    def _buffer(self):
+        """
+        Returns a buffer object over `buf` (not a copy of it, so a memory
+        map stays shared), its slices are byte strings and much faster
+        than slices of `buf`
+        """
+        if self._view is None:
+            self._view = buffer(self.buf)
+        return self._view
+
+    def index(self, word):
+        """
+        Returns index of `word`, raises KeyError for an unknown word
+        """
+
+        raw = _encode(word)
+
+        view, offsets, order = self._buffer(), self.offsets, self.order
+
+        # (`item` gives Python ints, numpy scalars are slow indices)
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = order.item(mid)
+            if view[offsets.item(i):offsets.item(i + 1)] < raw:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < len(order):
+            i = order.item(lo)
+            if view[offsets.item(i):offsets.item(i + 1)] == raw:
+                return i
+
+        raise KeyError(word)
+
+    def __eq__(self, other):
+        return (
+            np.array_equal(self.offsets, other.offsets)
+            and np.array_equal(self.buf, other.buf)
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class _Word2I(object):
+    """
+    Read-only dict-like view: word -> index
+    """
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __getitem__(self, word):
+        return self.vocab.index(word)
+
+    def __contains__(self, word):
+        try:
+            self.vocab.index(word)
+        except (KeyError, TypeError, AttributeError):
+            return False
+        return True
+
+    def get(self, word, default=None):
+        try:
+            return self.vocab.index(word)
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def __iter__(self):
+        return (self.vocab.word(i) for i in range(len(self.vocab)))
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(range(len(self.vocab)))
+
+    def items(self):
+        return [(self.vocab.word(i), i) for i in range(len(self.vocab))]
+
+
+class _I2Word(object):
+    """
+    Read-only dict-like view: index -> word
+    """
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self.vocab):
+            raise KeyError(i)
+        return self.vocab.word(i)
+
+    def __contains__(self, i):
+        return 0 <= i < len(self.vocab)
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def __iter__(self):
+        return iter(range(len(self.vocab)))
+
+    def items(self):
+        return [(i, self.vocab.word(i)) for i in range(len(self.vocab))]
@@ -5,6 +5,9 @@ Weightings
 Use if you have a raw co-occurrence matrix
 in scipy.sparse.csr_matrix data structure
 (see the subsection 1.4.2)
+
+Values are weighted in place, in the dtype of the matrix, so a float32
+matrix stays float32 (with no float64 temporaries of its size).
 """
 
 import numpy as np
@@ -18,38 +21,114 @@ def log(m):
     m.data = np.log(1 + m.data)
 
 
-def ppmi(m):
+def ppmi(m, chunk_size=None, marginals=None):
+    """
+    If `chunk_size` is given, values are processed in blocks of rows
+    with at most `chunk_size` values, which caps temporary memory
+
+    If `m` is just a block of rows of a matrix, give `marginals`
+    of the whole matrix (see `marginals_of`), with row sums of the block
+    """
+
+    row_sums, col_sums, all_sum = _in_dtype(
+        marginals_of(m) if marginals is None else marginals, m.dtype
+    )
+
+    for beg, end in row_blocks(m, chunk_size):
+        lo, hi = m.indptr[beg], m.indptr[end]
+        data = m.data[lo:hi]
+
+        denom = col_sums[m.indices[lo:hi]]
+        denom *= np.repeat(row_sums[beg:end], np.diff(m.indptr[beg:end + 1]))
+
+        data *= all_sum
+        data /= 0.00001 + denom
+
+        m.data[lo:hi] = np.log(data).clip(min=0.0)
+
+
+def log_dice(m, chunk_size=None, marginals=None):
+    """
+    If `chunk_size` is given, values are processed in blocks of rows
+    with at most `chunk_size` values, which caps temporary memory
+
+    If `m` is just a block of rows of a matrix, give `marginals`
+    of the whole matrix (see `marginals_of`), with row sums of the block
+    """
+
+    row_sums, col_sums, __ = _in_dtype(
+        marginals_of(m) if marginals is None else marginals, m.dtype
+    )
+
+    for beg, end in row_blocks(m, chunk_size):
+        lo, hi = m.indptr[beg], m.indptr[end]
+        data = m.data[lo:hi]
+
+        denom = col_sums[m.indices[lo:hi]] + 0.00001
+        denom += np.repeat(row_sums[beg:end], np.diff(m.indptr[beg:end + 1]))
+
+        data *= 2
+        data /= denom
+
+        m.data[lo:hi] = (14 + np.log2(data)).clip(min=0.0)
+
+
+# Weightings depending on sums of the whole matrix (`marginals`)
+NEEDS_MARGINALS = (ppmi, log_dice)
+
+
+def marginals_of(m, upper=False):
+    """
+    Returns (row sums, col sums, sum of all values) of matrix `m`
+
+    Sums are accumulated in float64 whatever the dtype of `m` is.
+
+    If `upper`, `m` is the upper triangle of a symmetric matrix
+    and the marginals are those of the whole matrix.  Weighting just
+    the triangle with them gives the triangle of the weighted matrix
+    (for `NEEDS_MARGINALS` as well as cell-wise weightings).
+    """
+
+    row_sums = np.array(m.sum(axis=1, dtype=np.float64))[:, 0]
+    col_sums = np.array(m.sum(axis=0, dtype=np.float64))[0, :]
+
+    if upper:
+        sums = row_sums + col_sums - m.diagonal()
+        return sums, sums, sums.sum()
+
+    return row_sums, col_sums, m.sum(dtype=np.float64)
 
-    all_sum = m.sum()
-    row_sums = np.array(m.sum(axis=1))[:, 0]
-    col_sums = np.array(m.sum(axis=0))[0, :]
 
-    m.data *= all_sum
+def _in_dtype(marginals, dtype):
+    """
+    Casts `marginals` to `dtype`, so that values computed from them
+    are not upcast
+    """
 
-    denom = col_sums[m.indices]
-    #
-    for i in range(m.shape[0]):
-        beg, end = m.indptr[i], m.indptr[i + 1]
-        denom[beg:end] *= row_sums[i]
-    #
-    m.data /= 0.00001 + denom
+    row_sums, col_sums, all_sum = marginals
 
-    m.data = np.log(m.data).clip(min=0.0)
+    return (np.asarray(row_sums, dtype=dtype),
+            np.asarray(col_sums, dtype=dtype), dtype.type(all_sum))
 
 
-def log_dice(m):
+def row_blocks(m, chunk_size=None):
+    """
+    Splits rows of csr_matrix `m` into ranges [beg, end) containing
+    at most `chunk_size` values (but at least one row)
+    """
 
-    row_sums = np.array(m.sum(axis=1))[:, 0]
-    col_sums = np.array(m.sum(axis=0))[0, :]
+    nb_rows = m.shape[0]
 
-    m.data *= 2
+    if chunk_size is None:
+        return [(0, nb_rows)]
 
-    denom = col_sums[m.indices] + 0.00001
-    #
-    for i in range(m.shape[0]):
-        beg, end = m.indptr[i], m.indptr[i + 1]
-        denom[beg:end] += row_sums[i]
-    #
-    m.data /= denom
+    blocks = []
+    beg = 0
+    while beg < nb_rows:
+        end = np.searchsorted(
+            m.indptr, m.indptr[beg] + chunk_size, side="right") - 1
+        end = min(max(end, beg + 1), nb_rows)
+        blocks.append((beg, end))
+        beg = end
 
-    m.data = (14 + np.log2(m.data)).clip(min=0.0)
+    return blocks
@@ -7,15 +7,30 @@ Script for transforming word sketch data into a sparse target-context
 co-occurrence matrix with the same parameters as original wm2thes.
 
 To save memory, the script does two-passes over the word sketch data.
+
+With `--single-pass`, the data are traversed only once: cells are
+stored in temporary files and then sorted in runs spilled to disk
+whenever they exceed the memory budget (see `runs.py`), so the output
+is written in the row-major (CSR-ready) order.
+
+Targets and contexts are indexed by decreasing frequencies, contexts
+are saved as (rel_id, coll_id) pairs in [OUTPUT_NAME]-contexts.npy.
 """
 
-import sys
-import pickle
+import argparse
+import os
 import numpy as np
 
 # Sketch Engine imports
-import wmap
-import manatee
+try:
+    import wmap
+    import manatee
+except ImportError:  # `convert` works on any stream of sketches
+    wmap = manatee = None
+
+# Local imports
+from runs import SortedRuns, ArrayWriter, MEMORY, encode, decode
+from vocab import Vocabulary
 
 # ------------------------------------------------------------------------------
 
@@ -27,10 +42,14 @@ TRIPLE_SCORE = 0
 
 # ------------------------------------------------------------------------------
 
+BATCH_SIZE = 10**5  # nb of cells buffered (or renumbered) at once
+
 
 def iter_word_sketches(corpus_id):
     """
-    Yields (word, rel_id, coll_id, score) quadruples.
+    Yields (word, rel_id, coll_id, score, word_count, count) sextuples,
+    where `word_count` is the frequency of the word and `count` is the
+    frequency of the triple.
     """
 
     corpus = manatee.Corpus(corpus_id)
@@ -40,7 +59,8 @@ def iter_word_sketches(corpus_id):
     wmap1 = wmap.WMap(wsbase, 0, 0, 0, corpus_id)
 
     while True:  # over targets
-        if wmap1.getcnt() > TARGET_COUNT:
+        word_count = wmap1.getcnt()
+        if word_count > TARGET_COUNT:
             word = attr.id2str(wmap1.getid())
             wmap2 = wmap1.nextlevel()
 
@@ -54,7 +74,7 @@ def iter_word_sketches(corpus_id):
                     rank = wmap3.getrnk()
 
                     if count > TRIPLE_COUNT and rank > TRIPLE_SCORE:
-                        yield (word, rel_id, coll_id, rank)
+                        yield (word, rel_id, coll_id, rank, word_count, count)
 
                     if not wmap3.next():
                         break
@@ -66,46 +86,188 @@ def iter_word_sketches(corpus_id):
             break
 
 
-def main():
+def convert(sketches, output_name, memory=MEMORY, tmp_dir=None):
+    """
+    Single-pass conversion of word sketches given as sextuples
+    (word, rel_id, coll_id, score, word_count, count),
+    e.g. from `iter_word_sketches`
+
+    Cells are stored in temporary files together with the indices of
+    targets and contexts in the order they first appear.  At the end,
+    they are renumbered by frequencies (see `save_vocabs`) and sorted
+    by rows and cols in runs of at most `memory` bytes spilled to
+    `tmp_dir`.
+    """
+
+    target2i = dict()
+    target_counts = []
+    context2i = dict()  # keys encoded as `rel_id << 32 | coll_id`
+    context_counts = []
+
+    runs = SortedRuns(memory, tmp_dir, val_dtype=np.float32)
+    cells = [
+        ArrayWriter(os.path.join(runs.directory, "cells-" + array + ".npy"),
+                    dtype, runs.directory)
+        for array, dtype in (("rows", np.int32), ("cols", np.int32),
+                             ("vals", np.float32))
+    ]
+    rows, cols, vals = [], [], []
+
+    for word, rel_id, coll_id, score, word_count, count in sketches:
+
+        row = target2i.setdefault(word, len(target2i))
+        if row == len(target_counts):
+            target_counts.append(word_count)
 
-    if len(sys.argv) != 3:
-        sys.stderr.write("Usage: python wm2thes.py CORPUS_NAME OUTPUT_NAME\n")
-        sys.exit(1)
+        col = context2i.setdefault(rel_id << 32 | coll_id, len(context2i))
+        if col == len(context_counts):
+            context_counts.append(0)
+        context_counts[col] += count
 
-    corpus_name = sys.argv[1]
-    output_name = sys.argv[2]
+        rows.append(row)
+        cols.append(col)
+        vals.append(score)
 
-    #
+        if len(rows) >= BATCH_SIZE:
+            for writer, chunk in zip(cells, (rows, cols, vals)):
+                writer.append(chunk)
+            rows, cols, vals = [], [], []
+
+    for writer, chunk in zip(cells, (rows, cols, vals)):
+        writer.append(chunk)
+        writer.close()
+
+    target_ids, context_ids = save_vocabs(
+        output_name, target2i, target_counts, context2i, context_counts)
+
+    rows, cols, vals = (
+        np.load(writer.path, mmap_mode="r") for writer in cells
+    )
+
+    for beg in range(0, len(rows), BATCH_SIZE):
+        end = beg + BATCH_SIZE
+        runs.add(encode(target_ids[rows[beg:end]], context_ids[cols[beg:end]]),
+                 vals[beg:end])
+    del rows, cols, vals
+
+    rows = ArrayWriter(output_name + "-rows.npy", np.int32, runs.directory)
+    cols = ArrayWriter(output_name + "-cols.npy", np.int32, runs.directory)
+    vals = ArrayWriter(output_name + "-vals.npy", np.float32, runs.directory)
+
+    for keys, chunk_vals in runs.merge():
+        chunk_rows, chunk_cols = decode(keys)
+        rows.append(chunk_rows)
+        cols.append(chunk_cols)
+        vals.append(chunk_vals)
+
+    for writer in (rows, cols, vals):
+        writer.close()
+    runs.close()
+
+
+def convert_two_passes(corpus_name, output_name):
 
     nb_cells = 0
-    targets = set()
-    contexts = set()
-    for word, rel_id, col_id, ___ in iter_word_sketches(corpus_name):
+    target2i = dict()
+    target_counts = []
+    context2i = dict()  # keys encoded as `rel_id << 32 | coll_id`
+    context_counts = []
+
+    for word, rel_id, coll_id, __, word_count, count in iter_word_sketches(
+            corpus_name):
         nb_cells += 1
-        targets.add(word)
-        contexts.add((rel_id, col_id))
 
-    # TODO: targets sorted by freqs
+        if target2i.setdefault(word, len(target2i)) == len(target_counts):
+            target_counts.append(word_count)
 
-    target2i = {target: i for i, target in enumerate(targets)}
-    context2i = {(rel, coll): i for i, (rel, coll) in enumerate(contexts)}
+        col = context2i.setdefault(rel_id << 32 | coll_id, len(context2i))
+        if col == len(context_counts):
+            context_counts.append(0)
+        context_counts[col] += count
+
+    target_ids, context_ids = save_vocabs(
+        output_name, target2i, target_counts, context2i, context_counts)
+
+    target2i = {word: target_ids[i] for word, i in target2i.items()}
+    context2i = {key: context_ids[i] for key, i in context2i.items()}
 
     # Sparse target-context co-occurrence matrix
-    rows = np.zeros((nb_cells,), dtype=np.int64)
-    cols = np.zeros((nb_cells,), dtype=np.int64)
+    rows = np.zeros((nb_cells,), dtype=np.int32)
+    cols = np.zeros((nb_cells,), dtype=np.int32)
     vals = np.zeros((nb_cells,), dtype=np.float32)
 
-    for i, (word, rel_id, coll_id, score) in enumerate(iter_word_sketches(corpus_name)):
+    sketches = iter_word_sketches(corpus_name)
+    for i, (word, rel_id, coll_id, score, __, __) in enumerate(sketches):
         rows[i] = target2i[word]
-        cols[i] = context2i[(rel_id, coll_id)]
+        cols[i] = context2i[rel_id << 32 | coll_id]
         vals[i] = score
 
     np.save(output_name + "-rows.npy", rows)
     np.save(output_name + "-cols.npy", cols)
     np.save(output_name + "-vals.npy", vals)
 
-    with open(output_name + "-target2i.pickle", "w") as f:
-        pickle.dump(target2i, f)
+
+def save_vocabs(output_name, target2i, target_counts, context2i,
+                context_counts):
+    """
+    Sorts targets and contexts by decreasing frequencies (ties broken
+    by words and ids) and saves them:
+
+        [OUTPUT_NAME]-vocab-*.npy       # targets (see `vocab.py`)
+        [OUTPUT_NAME]-contexts.npy      # (rel_id, coll_id) of contexts
+
+    Returns arrays mapping the given indices to the sorted ones.
+    """
+
+    words = [None] * len(target2i)
+    for word, i in target2i.items():
+        words[i] = word
+
+    keys = np.zeros((len(context2i), ), dtype=np.int64)
+    for key, i in context2i.items():
+        keys[i] = key
+
+    target_order = sorted(range(len(words)),
+                          key=lambda i: (-target_counts[i], words[i]))
+    context_order = np.lexsort((keys, -np.array(context_counts)))
+
+    Vocabulary.from_words(words[i] for i in target_order).save(output_name)
+
+    contexts = np.zeros((len(keys), 2), dtype=np.int32)
+    contexts[:, 0], contexts[:, 1] = decode(keys[context_order])
+    np.save(output_name + "-contexts.npy", contexts)
+
+    return _inverse(target_order), _inverse(context_order)
+
+
+def _inverse(order):
+    """
+    Inverse permutation: new index of each old one
+    """
+    inverse = np.zeros((len(order), ), dtype=np.int32)
+    inverse[order] = np.arange(len(order), dtype=np.int32)
+    return inverse
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Converts word sketches into a target-context matrix.")
+    parser.add_argument("corpus_name", metavar="CORPUS_NAME")
+    parser.add_argument("output_name", metavar="OUTPUT_NAME")
+    parser.add_argument("--single-pass", action="store_true",
+                        help="traverse the word sketches only once")
+    parser.add_argument("--memory", type=int, default=MEMORY // 10**6,
+                        help="memory budget for --single-pass in MB")
+    parser.add_argument("--tmp-dir", default=None,
+                        help="directory for temporary sorted runs")
+    args = parser.parse_args()
+
+    if args.single_pass:
+        convert(iter_word_sketches(args.corpus_name), args.output_name,
+                memory=args.memory * 10**6, tmp_dir=args.tmp_dir)
+    else:
+        convert_two_passes(args.corpus_name, args.output_name)
 
 
 if __name__ == "__main__":